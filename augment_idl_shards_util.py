@@ -1,121 +1,407 @@
 import argparse
+import io
 import os
+import glob
 import json
 import tarfile
 import tempfile
 from PIL import Image
 import concurrent.futures
-from typing import List, Tuple
-from webdataset import TarWriter
+import multiprocessing
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterator, List, Optional, Tuple
 import shutil
 from functools import partial
-from render_text_on_image import mask_and_replace_text
+from render_text_on_image import AugmentationPool, ParallelConfig, RenderConfig, build_caches, mask_and_replace_text, set_memory_budget
+from font_cache import FontCache
+from tiff_encoding import CODECS, EncodeConfig
+from shard_writers import SAMPLE_KEY_RE, VariantWriters, WriterConfig, count_output_samples, output_parts
 from text_aug import TextAugmenter
+from augmentation_backends import AugmentationBackend, LocalModelBackend
+from pos_tagging import build_pos_tagger
+from synonym_index import SynonymIndex
+from instrumentation import METRICS, MetricsReporter, count, reset_metrics, timed
 import logging
 import time
 from datetime import datetime
-from threading import Lock
 
-# Configure logging
-
-logging.basicConfig(level=logging.INFO, filename=datetime.now().strftime('/fsx/dana_aubakirova/data-logs/70_data_aug_%H_%M_%d_%m_%Y.log'), filemode='w',
-                    format='%(asctime)s - %(levelname)s - %(message)s')
-
-class ThreadSafeSet:
-    def __init__(self):
-        self.set = set()
-        self.lock = Lock()
-    
-    def add(self, item):
-        with self.lock:
-            if item in self.set:
-                return False
-            self.set.add(item)
-            return True
-    
-    def __contains__(self, item):
-        with self.lock:
-            return item in self.set
-write_lock = Lock()
-written_files = ThreadSafeSet()
-Image.MAX_IMAGE_PIXELS = None
 _logger = logging.getLogger('endless_attempts')
-def process_pair(tiff_path: str, json_path: str, writers: List[TarWriter], pair_base_name: str, font_dir: str, rand_aug: TextAugmenter):
+def write_versions(images, jsons, writers: VariantWriters, pair_base_name: str):
+    for version, (img, metadata) in enumerate(zip(images, jsons)):
+        metadata_bytes = json.dumps(metadata).encode('utf-8')
+        key_name = f"{pair_base_name}_{version}"
+        # handed to the writer thread of the variant, which also drops duplicate keys
+        writers.write(version, {"__key__": key_name, "tif": img.getvalue(), "json": metadata_bytes})
+
+def process_pair(tiff_path: str, json_path: str, writers: VariantWriters, pair_base_name: str, font_dir: str, rand_aug: AugmentationBackend, pool: AugmentationPool, page_threads: int, render_config: RenderConfig, encode_config: EncodeConfig, seed: Optional[int] = None) -> Optional[int]:
+    """Augments and writes one document; returns its number of pages, or None if it failed (the error is logged)."""
     _logger.info(f"Processing pair: {tiff_path} and {json_path}")
     try:
-        image = Image.open(tiff_path)
+        with timed("tiff_open"):
+            image = Image.open(tiff_path)
         with open(json_path, 'r') as json_file:
             metadata = json.load(json_file)
         
-        images, jsons = mask_and_replace_text(image, metadata, font_dir, rand_aug)
-
-        for version, (img, metadata) in enumerate(zip(images, jsons)):
-            metadata_bytes = json.dumps(metadata).encode('utf-8')
-            key_name = f"{pair_base_name}_{version}"
-            if not written_files.add(key_name):
-                _logger.info(f"Skipping writing {key_name} as it's already processed.")
-                continue
-            sample_to_write = {"__key__": key_name, "tif": img.getvalue(), "json": metadata_bytes}
-            with write_lock:
-                writers[version].write(sample_to_write)
-                _logger.info(f"Wrote {key_name} to tar.")
-            #sample_to_write = {"__key__": key_name, "tif": img.getvalue(), "json": metadata_bytes}
-            #with write_lock:
-                #writers[version].write(sample_to_write)  
-                #_logger.info(f"Wrote {key_name} to tar.")
+        images, jsons = mask_and_replace_text(image, metadata, font_dir, rand_aug, pool, page_threads, render_config, encode_config, len(writers),
+                                              seed, pair_base_name)
+        write_versions(images, jsons, writers, pair_base_name)
     except Exception as e:
         _logger.error(f"Error processing image {tiff_path}: {e}", exc_info=True)
+        return None
+    return len(metadata['pages'])
 
-def process_tar_file(tar_path: str, temp_dir: str, final_dir: str, n_parallel_files_per_shard: int, font_dir: str, rand_aug: TextAugmenter):
+def iter_tar_samples(tar_path: str) -> Iterator[Tuple[str, Dict[str, bytes]]]:
+    """
+    Reads a tar member by member and yields (key, {extension: bytes}) for every run of consecutive
+    members sharing a key, with webdataset's key rule: everything up to the first dot of the file name.
+    """
+    current_key, current_sample = None, {}
+    with tarfile.open(tar_path, "r|*") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            match = SAMPLE_KEY_RE.match(member.name)
+            if match is None:
+                _logger.warning(f"Skipping {member.name} in {tar_path}: no extension.")
+                continue
+            key, extension = match.groups()
+            if key != current_key:
+                if current_key is not None:
+                    yield current_key, current_sample
+                current_key, current_sample = key, {}
+            current_sample[extension.lower()] = tar.extractfile(member).read()
+    if current_key is not None:
+        yield current_key, current_sample
 
+def process_tar_file(tar_path: str, temp_dir: str, final_dir: str, config: ParallelConfig, font_dir: str, rand_aug: AugmentationBackend,
+                     render_config: RenderConfig, encode_config: EncodeConfig, n_variants: int = 3,
+                     writer_config: Optional[WriterConfig] = None, seed: Optional[int] = None) -> Dict[str, int]:
+    """Extracts one shard to temp_dir and processes its documents with file threads; returns its documents, pages and failed counts."""
     with tarfile.open(tar_path, "r") as tar:
         tar.extractall(path=temp_dir)
     files = os.listdir(temp_dir)
-    # check if logic here is sound - maybe an assert to check if pairs are indeed matched pairwise
-    tiffs = sorted(f for f in files if f.endswith('.tif'))
-    jsons = sorted(f for f in files if f.endswith('.json'))
-    total_length = len(jsons)
+    # pair by base name, not by sorted position, so a missing member cannot shift every following pair
+    tiffs = {os.path.splitext(f)[0]: f for f in files if f.endswith('.tif')}
+    jsons = {os.path.splitext(f)[0]: f for f in files if f.endswith('.json')}
+    for unpaired in sorted(tiffs.keys() ^ jsons.keys()):
+        _logger.warning(f"Skipping incomplete sample {unpaired} in {tar_path}.")
+    pair_keys = sorted(tiffs.keys() & jsons.keys())
 
-    writers = [TarWriter(f"{final_dir}/{os.path.splitext(os.path.basename(tar_path))[0]}_{i}.tar") for i in range(3)]
-    pair_paths = [(os.path.join(temp_dir, tiffs[i]), os.path.join(temp_dir, jsons[i])) for i in range(len(tiffs))]
+    # one writer thread per variant
+    writers = VariantWriters(final_dir, os.path.splitext(os.path.basename(tar_path))[0], n_variants, writer_config)
+    pair_paths = [(os.path.join(temp_dir, tiffs[key]), os.path.join(temp_dir, jsons[key])) for key in pair_keys if not writers.is_done(key)]
     # pre-pass writers and temp dir to a partial func in order to map the pairs we want to it
     # each writer will be copied n_parallel_shards times, but that should be an ok tradeoff
-    process_function = partial(process_pair_wrapper, writers=writers, font_dir=font_dir, rand_aug=rand_aug)
+    # one augmentation pool for the whole shard, shared by every file and page thread
+    pool = AugmentationPool(rand_aug, config.aug_processes)
+    process_function = partial(process_pair_wrapper, writers=writers, font_dir=font_dir, rand_aug=rand_aug, pool=pool, page_threads=config.page_threads, render_config=render_config, encode_config=encode_config, seed=seed)
+    totals = {"documents": 0, "pages": 0, "failed": 0}
     try:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=n_parallel_files_per_shard) as executor:
-            executor.map(process_function, pair_paths)
-    except Exception as e:
-        _logger.error(f"Failed to process tar file {tar_path}: {e}", exc_info=True)    
+        with concurrent.futures.ThreadPoolExecutor(max_workers=config.file_threads) as executor:
+            for n_pages in executor.map(process_function, pair_paths):
+                if n_pages is None:
+                    totals["failed"] += 1
+                else:
+                    totals["documents"] += 1
+                    totals["pages"] += n_pages
     finally:
-        for writer in writers:  
-            writer.close()
+        pool.close()
+        writers.close()
         shutil.rmtree(temp_dir)
         _logger.info("Cleaning up resources.")
+    return totals
 
-def process_pair_wrapper(pair_paths, writers, font_dir, rand_aug):
+def process_pair_wrapper(pair_paths, writers, font_dir, rand_aug, pool, page_threads, render_config, encode_config, seed=None):
 
     tiff_path, json_path = pair_paths
     pair_base_name = os.path.splitext(os.path.basename(tiff_path))[0]
-    process_pair(tiff_path, json_path, writers, pair_base_name, font_dir, rand_aug)
+    return process_pair(tiff_path, json_path, writers, pair_base_name, font_dir, rand_aug, pool, page_threads, render_config, encode_config, seed)
+
+def verify_shard(tar_path: str, final_dir: str, n_variants: int) -> bool:
+    """Checks that every complete (tif, json) sample of the input shard appears exactly once in the output of each variant."""
+    base_name = os.path.splitext(os.path.basename(tar_path))[0]
+    input_keys = [os.path.basename(key) for key, sample in iter_tar_samples(tar_path) if 'tif' in sample and 'json' in sample]
+    ok = True
+    for i in range(n_variants):
+        counts: Dict[str, int] = {}
+        parts = output_parts(final_dir, base_name, i)
+        for part in parts:
+            count_output_samples(part, counts)
+        expected = {f"{key}_{i}" for key in input_keys}
+        missing = sorted(expected - counts.keys())
+        duplicated = sorted(key for key, count in counts.items() if count > 1)
+        unexpected = sorted(counts.keys() - expected)
+        print(f"{base_name} variant {i}: {len(parts)} files, {len(expected)} expected, {len(missing)} missing, "
+              f"{len(duplicated)} duplicated, {len(unexpected)} unexpected")
+        for name, keys in (("missing", missing), ("duplicated", duplicated), ("unexpected", unexpected)):
+            if keys:
+                print(f"  {name}: {' '.join(keys[:20])}{' ...' if len(keys) > 20 else ''}")
+        ok = ok and not (missing or duplicated or unexpected)
+    return ok
 
-def process_directory(current_shard: str, final_dir: str, n_parallel_shards: int, n_parallel_files_per_shard: int, font_dir: str, rand_aug: TextAugmenter):
-    _logger.info("Starting to process directory.")
+def _init_shard_worker(memory_budget: Optional[int]):
+    reset_metrics()
+    set_memory_budget(memory_budget)
+
+def _process_tar_file_in_worker(*args):
+    totals = process_tar_file(*args)
+    return totals, METRICS.drain()
+
+def process_tar_files(shard_paths: List[str], final_dir: str, n_workers: int, config: ParallelConfig, font_dir: str,
+                      rand_aug: AugmentationBackend, render_config: RenderConfig, encode_config: EncodeConfig, n_variants: int = 3,
+                      writer_config: Optional[WriterConfig] = None, seed: Optional[int] = None) -> Dict[str, float]:
+    """
+    --extract_to_temp scheduling: one shard per worker process, each with its own file threads and augmentation pool.
+    Totals are counted as in process_shards. A worker that dies breaks the pool and every shard in it; those shards are
+    then rerun one at a time in a new pool, resuming from their manifests, so only a shard that kills a worker on its
+    own, or that raises, counts as unread.
+    """
+    totals = {"shards": 0, "unread_shards": 0, "documents": 0, "pages": 0, "failed": 0}
     start_time = time.time()
-    #tar_files = sorted(f for f in os.listdir(directory) if f.endswith('.tar'))
-   # all_tar_files = [f for f in os.listdir(directory) if f.endswith('.tar')]
-    #print(all_tar_files)
-    #tar_files = sorted(f for f in all_tar_files if f.endswith('.tar') and '00010' <= f[10:15] <= '00029')
-    #print(tar_files)
-    #tar_files = sorted(directory)
-    with concurrent.futures.ProcessPoolExecutor(max_workers=n_parallel_shards) as executor:
-        futures = []
-        #for tar in tar_files:
-        temp_dir = tempfile.mkdtemp()
-        futures.append(executor.submit(process_tar_file, current_shard, temp_dir, final_dir, n_parallel_files_per_shard, font_dir, rand_aug))
-        concurrent.futures.wait(futures)
 
+    def run(paths: List[str], workers: int) -> List[str]:
+        # the shards lost to a dead worker are returned
+        lost = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_shard_worker,
+                                                    initargs=(config.memory_budget,)) as executor:
+            futures = {}
+            for tar_path in paths:
+                temp_dir = tempfile.mkdtemp()
+                futures[executor.submit(_process_tar_file_in_worker, tar_path, temp_dir, final_dir, config, font_dir, rand_aug,
+                                        render_config, encode_config, n_variants, writer_config, seed)] = (tar_path, temp_dir)
+            for future in concurrent.futures.as_completed(futures):
+                tar_path, temp_dir = futures[future]
+                # left behind when the worker died or failed before its own clean-up
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                try:
+                    shard_totals, metrics = future.result()
+                except BrokenProcessPool:
+                    lost.append(tar_path)
+                    continue
+                except Exception as e:
+                    totals["unread_shards"] += 1
+                    _logger.error(f"Failed to process tar file {tar_path}: {e}", exc_info=True)
+                    continue
+                METRICS.merge(metrics)
+                totals["shards"] += 1
+                for name, value in shard_totals.items():
+                    totals[name] += value
+                _logger.info(f"Finished shard {tar_path}.")
+        return lost
+
+    lost = run(shard_paths, n_workers)
+    if lost:
+        count("pool_restarts")
+        _logger.warning(f"A worker process died, rerunning {len(lost)} shards one at a time.")
+        for tar_path in lost:
+            if run([tar_path], 1):
+                totals["unread_shards"] += 1
+                _logger.error(f"Shard {tar_path} was not processed to the end: its worker process died.")
+    elapsed = time.time() - start_time
+    totals.update(seconds=elapsed, documents_per_sec=totals["documents"] / elapsed, pages_per_sec=totals["pages"] / elapsed,
+                  variants_per_sec=totals["documents"] * n_variants / elapsed)
+    return totals
+
+def list_shards(shards: str, node_index: int = 0, n_nodes: int = 1) -> List[str]:
+    """The tar files of a directory, a glob or a single path, sorted, and every n_nodes-th of them starting at node_index."""
+    if os.path.isdir(shards):
+        paths = glob.glob(os.path.join(glob.escape(shards), "*.tar"))
+    else:
+        paths = glob.glob(shards)
+    return sorted(paths)[node_index::n_nodes]
+
+_worker_state = {}
+
+def _init_document_worker(rand_aug: AugmentationBackend, font_dir: str, page_threads: int, render_config: RenderConfig,
+                          encode_config: EncodeConfig, n_variants: int, seed: Optional[int] = None, memory_budget: Optional[int] = None):
+    # the augmenter arrives once per worker process and serves every document of every shard it is handed
+    _worker_state.update(rand_aug=rand_aug, font_dir=font_dir, page_threads=page_threads, render_config=render_config,
+                         encode_config=encode_config, n_variants=n_variants, seed=seed)
+    reset_metrics()
+    set_memory_budget(memory_budget)
+
+def _process_document(key: str, tiff_bytes: bytes, json_bytes: bytes):
+    state = _worker_state
+    with timed("tiff_open"):
+        image = Image.open(io.BytesIO(tiff_bytes))
+    metadata = json.loads(json_bytes)
+    images, jsons = mask_and_replace_text(image, metadata, state['font_dir'], state['rand_aug'], None, state['page_threads'],
+                                          state['render_config'], state['encode_config'], state['n_variants'], state['seed'], key)
+    # the worker's timings travel back with every document
+    return images, jsons, len(metadata['pages']), METRICS.drain()
+
+def process_shards(shard_paths: List[str], final_dir: str, n_workers: int, config: ParallelConfig, font_dir: str, rand_aug: AugmentationBackend,
+                   max_in_flight: int = 24, render_config: Optional[RenderConfig] = None, encode_config: Optional[EncodeConfig] = None,
+                   n_variants: int = 3, writer_config: Optional[WriterConfig] = None, seed: Optional[int] = None) -> Dict[str, float]:
+    """
+    Document-level scheduling across shards: the shards are read one after the other in this process and every
+    document is a task for one pool of n_workers processes, so a worker that is done pulls the next document,
+    whichever shard it is in. Results come back here and go to the writers of their shard, which are closed as
+    soon as the last document of the shard is written.
+
+    A worker that dies (e.g. killed for running out of memory) breaks the pool and every document in it. The pool
+    is then restarted and those documents are retried one at a time, so only a document that kills a worker on
+    its own is failed. Shards that could not be read to the end count as unread_shards, not as shards.
+    """
+    render_config = render_config or RenderConfig()
+    encode_config = encode_config or EncodeConfig()
+    totals = {"shards": 0, "unread_shards": 0, "documents": 0, "pages": 0, "failed": 0}
+    shard_writers: Dict[str, VariantWriters] = {}
+    pending: Dict[str, int] = {}
+    read_done = set()
+    unread = set()
+    in_flight: Dict[concurrent.futures.Future, Tuple[str, str, Dict[str, bytes]]] = {}
+    executor = None
+
+    def start_workers(mp_context=None):
+        nonlocal executor
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context, initializer=_init_document_worker,
+                                                          initargs=(rand_aug, font_dir, config.page_threads, render_config, encode_config,
+                                                                    n_variants, seed, config.memory_budget))
+        concurrent.futures.wait([executor.submit(int) for _ in range(n_workers)])
+
+    def finish_shard(shard: str):
+        shard_writers.pop(shard).close()
+        if shard in unread:
+            totals["unread_shards"] += 1
+            _logger.error(f"Shard {shard} was not read to the end.")
+        else:
+            totals["shards"] += 1
+            _logger.info(f"Finished shard {shard}.")
+
+    def document_done(shard: str):
+        pending[shard] -= 1
+        if pending[shard] == 0 and shard in read_done:
+            finish_shard(shard)
+
+    def fail_document(shard: str, key: str, error: BaseException):
+        totals["failed"] += 1
+        _logger.error(f"Error processing sample {key} of {shard}: {error}", exc_info=error)
+        document_done(shard)
+
+    def write_result(future: concurrent.futures.Future, shard: str, key: str) -> bool:
+        """Writes one finished document; False, and nothing written, if it was lost with a broken pool."""
+        try:
+            images, jsons, n_pages, metrics = future.result()
+            METRICS.merge(metrics)
+            write_versions(images, jsons, shard_writers[shard], os.path.basename(key))
+            totals["documents"] += 1
+            totals["pages"] += n_pages
+        except BrokenProcessPool:
+            return False
+        except Exception as e:
+            fail_document(shard, key, e)
+            return True
+        document_done(shard)
+        return True
+
+    def recover():
+        lost = []
+        # a broken pool fails every document still in it at once
+        concurrent.futures.wait(in_flight)
+        for future, (shard, key, sample) in list(in_flight.items()):
+            del in_flight[future]
+            if not write_result(future, shard, key):
+                lost.append((shard, key, sample))
+        executor.shutdown()
+        count("pool_restarts")
+        _logger.warning(f"A worker process died, restarting the pool and retrying {len(lost)} documents one at a time.")
+        # the writer threads exist now, so new workers must not be forked from this process
+        start_workers(multiprocessing.get_context("forkserver"))
+        for shard, key, sample in lost:
+            future = executor.submit(_process_document, os.path.basename(key), sample['tif'], sample['json'])
+            concurrent.futures.wait([future])
+            if not write_result(future, shard, key):
+                fail_document(shard, key, RuntimeError("the worker process died on this document alone"))
+                executor.shutdown()
+                start_workers(multiprocessing.get_context("forkserver"))
+
+    def collect(done):
+        broken = False
+        for future in done:
+            if future not in in_flight:
+                continue
+            shard, key, sample = in_flight.pop(future)
+            if not write_result(future, shard, key):
+                # back in, recover() retries it with the rest of the lost documents
+                in_flight[future] = (shard, key, sample)
+                broken = True
+        if broken:
+            recover()
+
+    def submit(shard: str, key: str, sample: Dict[str, bytes]):
+        try:
+            future = executor.submit(_process_document, os.path.basename(key), sample['tif'], sample['json'])
+        except BrokenProcessPool:
+            recover()
+            future = executor.submit(_process_document, os.path.basename(key), sample['tif'], sample['json'])
+        in_flight[future] = (shard, key, sample)
+        pending[shard] += 1
+
+    start_time = time.time()
+    # start every worker before the writer threads exist, so none is forked from a process holding their locks
+    start_workers()
+    try:
+        for tar_path in shard_paths:
+            shard_writers[tar_path] = writers = VariantWriters(final_dir, os.path.splitext(os.path.basename(tar_path))[0], n_variants, writer_config)
+            pending[tar_path] = 0
+            try:
+                for key, sample in iter_tar_samples(tar_path):
+                    if 'tif' not in sample or 'json' not in sample:
+                        _logger.warning(f"Skipping incomplete sample {key} in {tar_path}: found {sorted(sample)}.")
+                        continue
+                    if writers.is_done(os.path.basename(key)):
+                        continue
+                    # at most max_in_flight documents are held in memory, over all shards
+                    if len(in_flight) >= max_in_flight:
+                        done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                        collect(done)
+                    submit(tar_path, key, sample)
+            except Exception as e:
+                unread.add(tar_path)
+                _logger.error(f"Failed to read tar file {tar_path}: {e}", exc_info=True)
+            read_done.add(tar_path)
+            if pending[tar_path] == 0:
+                finish_shard(tar_path)
+        while in_flight:
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            collect(done)
+    finally:
+        executor.shutdown()
+    elapsed = time.time() - start_time
+    totals.update(seconds=elapsed, documents_per_sec=totals["documents"] / elapsed, pages_per_sec=totals["pages"] / elapsed,
+                  variants_per_sec=totals["documents"] * n_variants / elapsed)
+    return totals
+
+def process_directory(shards: str, final_dir: str, n_parallel_shards: int, config: ParallelConfig, font_dir: str, rand_aug: AugmentationBackend,
+                      extract_to_temp: bool = False, max_in_flight: int = 24, render_config: Optional[RenderConfig] = None,
+                      encode_config: Optional[EncodeConfig] = None, n_variants: int = 3,
+                      writer_config: Optional[WriterConfig] = None, node_index: int = 0, n_nodes: int = 1,
+                      metrics_interval: float = 60.0, metrics_report: Optional[str] = None, seed: Optional[int] = None):
+    if n_variants < 1:
+        # with no writers every document would look done and be skipped
+        raise ValueError(f"n_variants must be at least 1, got {n_variants}.")
+    render_config = render_config or RenderConfig()
+    encode_config = encode_config or EncodeConfig()
+    shard_paths = list_shards(shards, node_index, n_nodes)
+    _logger.info(f"Starting to process {len(shard_paths)} shards (node {node_index} of {n_nodes}).")
+    start_time = time.time()
+    METRICS.reset()
+    with MetricsReporter(metrics_interval, metrics_report):
+        if extract_to_temp:
+            totals = process_tar_files(shard_paths, final_dir, n_parallel_shards, config, font_dir, rand_aug, render_config, encode_config,
+                                       n_variants, writer_config, seed)
+        else:
+            totals = process_shards(shard_paths, final_dir, n_parallel_shards, config, font_dir, rand_aug, max_in_flight, render_config,
+                                    encode_config, n_variants, writer_config, seed)
     end_time = time.time()
     _logger.info(f"Finished processing directory in {end_time - start_time:.2f} seconds.")
+    summary = (f"{totals['shards']} shards ({totals['unread_shards']} unread), {totals['documents']} documents ({totals['failed']} failed), {totals['pages']} pages "
+               f"in {totals['seconds']:.1f}s: {totals['documents_per_sec']:.3f} documents/sec, {totals['pages_per_sec']:.3f} pages/sec, "
+               f"{totals['variants_per_sec']:.3f} variants/sec")
+    _logger.info(summary)
+    print(summary)
+    return totals
 '''
 
 def process_single_tar(current_shard: str, final_dir: str,  n_parallel_files_per_shard: int, font_dir: str, rand_aug: TextAugmenter):
@@ -139,17 +425,94 @@ if __name__ == "__main__":
     """
     parser = argparse.ArgumentParser(description="Process webdataset shards in parallel.")
     parser.add_argument("--current_shard", type=str, help="The shard to process when using job arrays.")
+    parser.add_argument("--shards", type=str, default=None, help="Directory or glob of shards to process instead of --current_shard.")
+    parser.add_argument("--node_index", type=int, default=0, help="Index of this node; it takes every --n_nodes-th shard starting here.")
+    parser.add_argument("--n_nodes", type=int, default=1, help="Number of nodes the shards are split over.")
     parser.add_argument("--final_dir", type=str, help="Directory to write the processed shards to.")
-    parser.add_argument("--n_parallel_shards", type=int, default=3, help="Number of processes to assign shards to.")
-    parser.add_argument("--n_parallel_files_per_shard", type=int, default=12, help="Number of threads to process files within a shard.")
+    parser.add_argument("--n_variants", type=int, default=3, help="Number of augmented versions made of every document, each written to its own output shard <shard>_<i>.tar.")
+    parser.add_argument("--shard_maxcount", type=int, default=None, help="Roll over to a new numbered output shard after this many samples per variant.")
+    parser.add_argument("--shard_maxsize", type=float, default=None, help="Roll over to a new numbered output shard after this many bytes per variant.")
+    parser.add_argument("--writer_queue_size", type=int, default=16, help="Samples queued per writer thread before the file threads wait.")
+    parser.add_argument("--log_file", type=str, default=None, help="Log file, may contain strftime fields (e.g. logs/data_aug_%%H_%%M_%%d_%%m_%%Y.log). Logs go to stderr if not given.")
+    parser.add_argument("--log_level", type=str, default="INFO", help="Logging level.")
+    parser.add_argument("--metrics_interval", type=float, default=60.0, help="Seconds between progress summaries of the stage timers and counters in the log (0 disables them).")
+    parser.add_argument("--metrics_report", type=str, default=None, help="Write the final stage timings and counters to this JSON file.")
+    parser.add_argument("--seed", type=int, default=0, help="Global seed. Every version of every page gets its own generator from (seed, sample key, version, page), so the output does not depend on the thread/process counts or on reruns.")
+    parser.add_argument("--verify", action="store_true", help="Only check that every sample of --current_shard appears exactly once in each variant output in --final_dir.")
+    parser.add_argument("--n_parallel_shards", type=int, default=3, help="Number of worker processes. Each loads the augmenter once and pulls documents from all shards (one whole shard per process with --extract_to_temp).")
+    parser.add_argument("--n_parallel_files_per_shard", type=int, default=None, help="With --extract_to_temp, number of threads to process files within a shard (12 if not given). Streaming workers take one document at a time.")
+    parser.add_argument("--max_in_flight", type=int, default=24, help="Maximum number of documents held in memory at once when streaming, over all shards.")
+    parser.add_argument("--extract_to_temp", action="store_true", help="Extract the whole shard to a temp directory first instead of streaming it member by member.")
+    parser.add_argument("--n_parallel_pages", type=int, default=3, help="Number of threads to process the pages of each file.")
+    parser.add_argument("--memory_budget_mb", type=float, default=None, help="Decoded and rendered pages each worker process holds at once, in MB (estimated from page size and mode). Pages wait for room; unlimited if not given.")
+    parser.add_argument("--max_image_pixels", type=int, default=None, help="Pillow's decompression bomb limit per page (PIL.Image.MAX_IMAGE_PIXELS); pages above twice the limit fail their document. Pillow's default if not given, 0 for no limit.")
+    parser.add_argument("--n_aug_processes", type=int, default=None, help="With --extract_to_temp, size of the text augmentation process pool shared by a whole shard (3 if not given, 0 augments in the page threads). Streaming workers and --aug_backend model augment in the page threads.")
     #parser.add_argument("--font_dir", type=str, default="/usr/share/fonts/truetype/liberation/LiberationSerif-Regular.ttf", help="The font directory that you want to use.")
     parser.add_argument("--font_dir", type=str, default="/usr/share/fonts/truetype/dejavu/DejaVuSerif.ttf", help="The font directory that you want to use.")
+    parser.add_argument("--fit_text_width", action="store_true", help="Shrink the font so the new text also fits the bbox width, not only its height.")
+    parser.add_argument("--render_mode", type=str, default="patch", choices=["patch", "full"], help="Render modified lines as patches over one shared copy of each page, or draw every version on a full copy.")
+    parser.add_argument("--tiff_codec", type=str, default="tiff_deflate", choices=CODECS, help="Compression of the output TIFF pages. group4 applies to bilevel pages, others fall back to deflate.")
+    parser.add_argument("--deflate_level", type=int, default=None, help="zlib level (1-9) for tiff_deflate, libtiff's default if not given.")
+    parser.add_argument("--n_encode_threads", type=int, default=3, help="Number of versions of a page encoded at once.")
+    parser.add_argument("--no_reuse_unchanged", action="store_true", help="Re-encode pages that are unchanged in every version instead of encoding them once / copying their original strips.")
+    parser.add_argument("--line_cache_size", type=int, default=0, help="Augmented lines kept per process by (backend, seed, version, op, line text), so repeated lines are not tagged and augmented again (0 disables it).")
+    parser.add_argument("--patch_cache_mb", type=float, default=0, help="MB of rendered text kept per process by (font, size, text), so repeated lines are not rendered again; text is then placed at whole pixels (0 disables it).")
+    parser.add_argument("--cache_dir", type=str, default=None, help="Node-local directory for on-disk stores of the line and patch caches, shared by all worker processes and reused by later runs with the same settings.")
+    parser.add_argument("--cache_disk_entries", type=int, default=1_000_000, help="Entries kept in each on-disk cache store before the least recently used are dropped.")
+    parser.add_argument("--max_cached_fonts", type=int, default=256, help="Number of (font, size) objects kept in the font cache of each process.")
     parser.add_argument("--stopwords_path", type=str, default="/fsx/dana_aubakirova/stopwords.txt", help="Path to the stopwords file for text processing.")
     parser.add_argument("--pos_model_path", type=str, default="/fsx/dana_aubakirova/stanford-postagger-2018-10-16/models/english-bidirectional-distsim.tagger", help="Path to the Stanford POS tagger model file.")
     parser.add_argument("--pos_jar_path", type=str, default="/fsx/dana_aubakirova/stanford-postagger-2018-10-16/stanford-postagger.jar", help="Path to the Stanford POS tagger jar file.")
+    parser.add_argument("--synonym_index", type=str, default=None, help="Prebuilt synonym index (python synonym_index.py --output ...), memory-mapped by every worker. Live WordNet is used if not given.")
+    parser.add_argument("--synonym_cache_size", type=int, default=200_000, help="Size of the (word, pos) LRU cache in front of the synonym lookups.")
+    parser.add_argument("--aug_backend", type=str, default="text", choices=["text", "model"], help="Line augmentation backend: the NLTK/WordNet ops of text_aug.TextAugmenter or a local model (augmentation_backends.LocalModelBackend).")
+    parser.add_argument("--model_path", type=str, default="stand-in", help="Local Hugging Face model directory for --aug_backend model, or stand-in for the tiny built-in stand-in model.")
+    parser.add_argument("--model_kind", type=str, default="seq2seq", choices=["seq2seq", "causal"], help="Architecture of --model_path.")
+    parser.add_argument("--model_max_batch_size", type=int, default=32, help="Lines per forward pass of the model, collected over all versions of the pages of a worker's page threads (and file threads with --extract_to_temp).")
+    parser.add_argument("--model_max_latency_ms", type=float, default=50.0, help="Longest a line waits for its batch to fill up before the batch is run anyway.")
+    parser.add_argument("--model_max_new_tokens", type=int, default=64, help="Longest completion generated per line.")
+    parser.add_argument("--model_threads", type=int, default=None, help="torch threads of each worker's model, torch's default if not given.")
+    parser.add_argument("--pos_backend", type=str, default="stanford", choices=["stanford", "rule"], help="POS tagger used for keyword replacement: a persistent Stanford JVM or the pure-Python rule-based fallback.")
 
     args = parser.parse_args()
+    if args.n_variants < 1:
+        parser.error("--n_variants must be at least 1.")
+    logging.basicConfig(level=args.log_level.upper(), filename=datetime.now().strftime(args.log_file) if args.log_file else None,
+                        filemode='w', format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.max_image_pixels is not None:
+        Image.MAX_IMAGE_PIXELS = args.max_image_pixels or None
+    shards = args.shards or args.current_shard
+    if args.verify:
+        results = [verify_shard(tar_path, args.final_dir, args.n_variants) for tar_path in list_shards(shards, args.node_index, args.n_nodes)]
+        raise SystemExit(0 if all(results) else 1)
     _logger.info('Data augmentation starts')
-    rand_aug = TextAugmenter(args.stopwords_path, args.pos_model_path, args.pos_jar_path)
-    process_directory(args.current_shard, args.final_dir, args.n_parallel_shards, args.n_parallel_files_per_shard, args.font_dir, rand_aug)
+    if args.aug_backend == "model":
+        rand_aug = LocalModelBackend(args.model_path, args.model_kind, args.model_max_batch_size, args.model_max_latency_ms / 1000,
+                                     args.model_max_new_tokens, threads=args.model_threads)
+    else:
+        pos_tagger = build_pos_tagger(args.pos_backend, args.pos_model_path, args.pos_jar_path)
+        synonym_index = SynonymIndex(args.synonym_index, cache_size=args.synonym_cache_size)
+        rand_aug = TextAugmenter(args.stopwords_path, pos_tagger=pos_tagger, synonym_index=synonym_index)
+    shard_options = {"file_threads": args.n_parallel_files_per_shard, "aug_processes": args.n_aug_processes}
+    if not args.extract_to_temp and any(value is not None for value in shard_options.values()):
+        _logger.warning("--n_parallel_files_per_shard and --n_aug_processes only apply with --extract_to_temp, ignoring them.")
+    elif args.n_aug_processes and rand_aug.batches:
+        _logger.warning("--aug_backend model batches the lines of all threads in each process, ignoring --n_aug_processes.")
+    config = ParallelConfig(page_threads=args.n_parallel_pages, memory_budget=int(args.memory_budget_mb * 2 ** 20) if args.memory_budget_mb else None,
+                            **{name: value for name, value in shard_options.items() if value is not None})
+    line_cache, patch_cache = build_caches(args.line_cache_size, args.patch_cache_mb, args.cache_dir, args.cache_disk_entries)
+    render_config = RenderConfig(fit_width=args.fit_text_width, font_cache=FontCache(args.max_cached_fonts), mode=args.render_mode,
+                                 line_cache=line_cache, patch_cache=patch_cache)
+    encode_config = EncodeConfig(codec=args.tiff_codec, deflate_level=args.deflate_level, workers=args.n_encode_threads,
+                                 reuse_unchanged=not args.no_reuse_unchanged)
+    totals = process_directory(shards, args.final_dir, args.n_parallel_shards, config, args.font_dir, rand_aug,
+                               extract_to_temp=args.extract_to_temp, max_in_flight=args.max_in_flight, render_config=render_config,
+                               encode_config=encode_config, n_variants=args.n_variants,
+                               writer_config=WriterConfig(maxcount=args.shard_maxcount, maxsize=args.shard_maxsize, queue_size=args.writer_queue_size),
+                               node_index=args.node_index, n_nodes=args.n_nodes, metrics_interval=args.metrics_interval,
+                               metrics_report=args.metrics_report, seed=args.seed)
+    rand_aug.close()
     _logger.info('Data augmentation stops')
+    # failed documents and unread shards are left for a rerun, which resumes from the manifests
+    if totals["failed"] or totals["unread_shards"]:
+        raise SystemExit(1)
@@ -0,0 +1,249 @@
+import hashlib
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from instrumentation import count, timed
+
+_logger = logging.getLogger('endless_attempts')
+
+# one instruction per augmentation op, {line} is replaced by the line
+DEFAULT_PROMPTS = {
+    'swap': "Reorder a few words of this line: {line}",
+    'deletion': "Drop a few words from this line: {line}",
+    'insertion': "Add a related word to this line: {line}",
+    'kreplacement': "Replace the keywords of this line with synonyms: {line}",
+}
+
+
+class AugmentationBackend:
+    """
+    Common interface of the text augmentation backends: a batch of lines and the op picked for each
+    line in, the new lines out, in the same order. Backends draw their random numbers from `rng` only.
+    Backends with needs_tags get the POS tags of their kreplacement lines, computed once per page.
+    Backends with batches collect the lines of concurrent calls into shared batches themselves, so they
+    are called from the threads of one process and never from an AugmentationPool's worker processes.
+    """
+    needs_tags = False
+    batches = False
+
+    def tag_batch(self, prompts: Sequence[str]) -> List[Any]:
+        return [None] * len(prompts)
+
+    def augment_batch(self, lines: Sequence[str], alpha: float, choices: Sequence[str], rng=random,
+                      tagged_lines: Optional[Dict[str, Any]] = None) -> List[str]:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    @property
+    def cache_tag(self) -> str:
+        """Identifies the backend's setup in the keys of cached results (see ContentCache)."""
+        return type(self).__name__
+
+
+def per_line_rngs(rng, n: int) -> List[Any]:
+    return list(rng) if isinstance(rng, (list, tuple)) else [rng] * n
+
+
+class Generator:
+    """A loaded text model: a batch of prompts and one seed per prompt in, one completion per prompt out."""
+
+    def generate(self, prompts: List[str], seeds: List[int]) -> List[str]:
+        raise NotImplementedError
+
+
+class StandInGenerator(Generator):
+    """
+    Tiny stand-in for a local model, for tests and benchmarks without transformers. It strips the
+    instruction and shuffles a few words of the line with Random(seed), so its output only depends
+    on the prompt and the seed. batch_seconds / line_seconds simulate the cost of a forward pass.
+    """
+
+    def __init__(self, batch_seconds: float = 0.0, line_seconds: float = 0.0):
+        self.batch_seconds = batch_seconds
+        self.line_seconds = line_seconds
+
+    def generate(self, prompts: List[str], seeds: List[int]) -> List[str]:
+        time.sleep(self.batch_seconds + self.line_seconds * len(prompts))
+        completions = []
+        for prompt, seed in zip(prompts, seeds):
+            words = prompt.split(': ', 1)[-1].split()
+            rng = random.Random(seed)
+            for _ in range(max(1, len(words) // 10)):
+                if len(words) > 1:
+                    i, j = rng.sample(range(len(words)), 2)
+                    words[i], words[j] = words[j], words[i]
+            completions.append(' '.join(words))
+        return completions
+
+
+class TransformersGenerator(Generator):
+    """
+    A local Hugging Face seq2seq or causal LM on CPU, with greedy decoding so a line's completion does
+    not depend on the seed. Needs transformers and torch, imported on construction.
+    """
+
+    def __init__(self, model_path: str, kind: str = "seq2seq", max_new_tokens: int = 64, threads: Optional[int] = None):
+        try:
+            import torch
+            from transformers import AutoModelForCausalLM, AutoModelForSeq2SeqLM, AutoTokenizer
+        except ImportError as e:
+            raise ImportError("The model backend needs transformers and torch (pip install transformers torch).") from e
+        if threads:
+            torch.set_num_threads(threads)
+        self._torch = torch
+        self.kind = kind
+        self.max_new_tokens = max_new_tokens
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        model_class = AutoModelForSeq2SeqLM if kind == "seq2seq" else AutoModelForCausalLM
+        self.model = model_class.from_pretrained(model_path).eval()
+        if kind == "causal":
+            # decoder-only models continue the prompt, so the batch is padded on the left
+            self.tokenizer.padding_side = "left"
+            if self.tokenizer.pad_token is None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+
+    def generate(self, prompts: List[str], seeds: List[int]) -> List[str]:
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True, truncation=True)
+        with self._torch.inference_mode():
+            outputs = self.model.generate(**inputs, max_new_tokens=self.max_new_tokens, do_sample=False,
+                                          pad_token_id=self.tokenizer.pad_token_id)
+        if self.kind == "causal":
+            outputs = outputs[:, inputs["input_ids"].shape[1]:]
+        return [text.strip().split('\n')[0] for text in self.tokenizer.batch_decode(outputs, skip_special_tokens=True)]
+
+
+class DynamicBatcher:
+    """
+    Collects the prompts of all threads of a process into batches for one generator thread. A batch
+    is run once it holds max_batch_size prompts or its first prompt has waited max_latency seconds.
+    """
+
+    def __init__(self, generator: Generator, max_batch_size: int = 32, max_latency: float = 0.05):
+        self.generator = generator
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_latency = max_latency
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="model-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt: str, seed: int) -> Future:
+        future = Future()
+        self._queue.put((prompt, seed, future))
+        return future
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_latency
+        while batch[-1] is not None and len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            stop = batch[-1] is None
+            requests = [request for request in batch if request is not None]
+            if requests:
+                prompts, seeds, futures = zip(*requests)
+                try:
+                    with timed("model_generate"):
+                        completions = self.generator.generate(list(prompts), list(seeds))
+                    count("model_batches")
+                    count("model_lines", len(requests))
+                    for future, completion in zip(futures, completions):
+                        future.set_result(completion)
+                except Exception as e:
+                    for future in futures:
+                        future.set_exception(e)
+            if stop:
+                return
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+class LocalModelBackend(AugmentationBackend):
+    """
+    Rewrites lines with a local model, prompting it with prompts[op]. The generator is loaded on first use
+    in every process and is not pickled, so each worker loads its own copy once. All lines of all pages and
+    documents the process is working on go through one DynamicBatcher. A seed is drawn from `rng` for every
+    line, so the rng advances the same way whatever the batches look like. `alpha` is not used.
+    model_path "stand-in" loads StandInGenerator; generator_factory (picklable) replaces the loading altogether.
+    """
+    batches = True
+
+    def __init__(self, model_path: str = "stand-in", kind: str = "seq2seq", max_batch_size: int = 32, max_latency: float = 0.05,
+                 max_new_tokens: int = 64, prompts: Optional[Dict[str, str]] = None, threads: Optional[int] = None,
+                 generator_factory: Optional[Callable[[], Generator]] = None):
+        self.model_path = model_path
+        self.kind = kind
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.max_new_tokens = max_new_tokens
+        self.prompts = dict(prompts or DEFAULT_PROMPTS)
+        self.threads = threads
+        self.generator_factory = generator_factory
+        self._batcher = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> Generator:
+        if self.generator_factory is not None:
+            return self.generator_factory()
+        if self.model_path == "stand-in":
+            return StandInGenerator()
+        _logger.info(f"Loading {self.kind} model {self.model_path}.")
+        return TransformersGenerator(self.model_path, self.kind, self.max_new_tokens, self.threads)
+
+    def _ensure_started(self) -> DynamicBatcher:
+        with self._lock:
+            # a forked worker inherits the object but not the batcher thread
+            if self._batcher is None or self._pid != os.getpid():
+                self._batcher = DynamicBatcher(self._load(), self.max_batch_size, self.max_latency)
+                self._pid = os.getpid()
+            return self._batcher
+
+    def augment_batch(self, lines: Sequence[str], alpha: float, choices: Sequence[str], rng=random,
+                      tagged_lines: Optional[Dict[str, Any]] = None) -> List[str]:
+        for choice in choices:
+            if choice not in self.prompts:
+                raise ValueError(f"No prompt for op {choice!r}. Choose from {sorted(self.prompts)}.")
+        batcher = self._ensure_started()
+        futures = [batcher.submit(self.prompts[choice].format(line=line), line_rng.getrandbits(32))
+                   for line, choice, line_rng in zip(lines, choices, per_line_rngs(rng, len(lines)))]
+        return [future.result() for future in futures]
+
+    @property
+    def cache_tag(self) -> str:
+        prompts = hashlib.blake2b(repr(sorted(self.prompts.items())).encode('utf-8'), digest_size=8).hexdigest()
+        return f"{type(self).__name__}/{self.model_path}/{self.kind}/{self.max_new_tokens}/{prompts}"
+
+    def close(self):
+        with self._lock:
+            if self._batcher is not None and self._pid == os.getpid():
+                self._batcher.close()
+                self._batcher = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_batcher'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
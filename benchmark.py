@@ -0,0 +1,525 @@
+import argparse
+import glob
+import io
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from typing import Callable, List, Sequence, Tuple
+
+from PIL import Image
+
+from augment_idl_shards_util import process_shards
+from augmentation_backends import LocalModelBackend, StandInGenerator
+from instrumentation import METRICS
+from pos_tagging import POSTagger, TaggedLine, build_pos_tagger
+from render_text_on_image import (AUG_CHOICES, AugmentationPool, MemoryBudget, ParallelConfig, RenderConfig, build_caches,
+                                  create_in_memory_tiff, mask_and_replace_text, render_text_patches, render_text_section)
+from synthetic_docs import boilerplate_lines, synthetic_page, write_synthetic_shard
+from synonym_index import SynonymIndex, wordnet_keyword_candidates, wordnet_synonyms
+from tiff_encoding import CODECS, EncodeConfig
+from text_aug import TextAugmenter
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples", "original")
+FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSerif.ttf"
+# used when no --stopwords_path is given, enough for RAKE and the insertion op to behave realistically
+DEFAULT_STOPWORDS = ["a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "he", "in", "is", "it",
+                     "its", "of", "on", "or", "that", "the", "this", "to", "was", "were", "will", "with"]
+Image.MAX_IMAGE_PIXELS = None
+
+
+def example_words(examples_dir: str) -> List[str]:
+    """All whitespace tokens of the example documents, repeats included, in reading order."""
+    words = []
+    for json_path in sorted(glob.glob(os.path.join(examples_dir, "*.json"))):
+        with open(json_path, 'r') as json_file:
+            for page in json.load(json_file)['pages']:
+                for line in page['text']:
+                    words.extend(line.split())
+    return words
+
+
+def example_documents(examples_dir: str) -> List[Tuple[str, bytes, dict]]:
+    documents = []
+    for json_path in sorted(glob.glob(os.path.join(examples_dir, "*.json"))):
+        key = os.path.splitext(os.path.basename(json_path))[0]
+        with open(os.path.join(examples_dir, key + ".tif"), 'rb') as tiff_file, open(json_path, 'r') as json_file:
+            documents.append((key, tiff_file.read(), json.load(json_file)))
+    return documents
+
+
+class StubTagger(POSTagger):
+    """Tags every token NN, so keyword replacement is measured without the cost or the variance of a real tagger."""
+
+    def tag_batch(self, lines: Sequence[Sequence[str]]) -> List[TaggedLine]:
+        return [[(word, 'NN') for word in tokens] for tokens in lines]
+
+
+def build_augmenter(args) -> TextAugmenter:
+    stopwords_path = args.stopwords_path
+    if stopwords_path is None:
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as stopwords_file:
+            stopwords_file.write('\n'.join(DEFAULT_STOPWORDS))
+        stopwords_path = stopwords_file.name
+    if args.pos_backend == 'stub':
+        pos_tagger = StubTagger()
+    else:
+        pos_tagger = build_pos_tagger(args.pos_backend, args.pos_model_path, args.pos_jar_path)
+    return TextAugmenter(stopwords_path, pos_tagger=pos_tagger, synonym_index=SynonymIndex(args.synonym_index))
+
+
+def example_lines(examples_dir: str) -> List[str]:
+    return [line for _, _, metadata in example_documents(examples_dir) for page in metadata['pages'] for line in page['text']]
+
+
+def parse_size(size: str) -> Tuple[int, int]:
+    width, height = size.lower().split('x')
+    return int(width), int(height)
+
+
+def lookups_per_second(lookup: Callable[[str, str], object], queries: List[Tuple[str, str]], repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for word, pos in queries:
+            lookup(word, pos)
+    return repeats * len(queries) / (time.perf_counter() - start)
+
+
+def bench_synonyms(args):
+    words = example_words(args.examples_dir)
+    # get_synonyms queries (pos None) and get_new_keyword queries with a noun tag, as the augmenter issues them
+    queries = [(word, None) for word in words] + [(word.lower(), 'n') for word in words]
+
+    def uncached(word, pos):
+        return wordnet_synonyms(word) if pos is None else wordnet_keyword_candidates(word, pos)
+
+    uncached(words[0], None)  # load the WordNet corpus outside of the timings
+    results = {"queries": len(queries), "uncached": lookups_per_second(uncached, queries, 1)}
+    live = SynonymIndex(cache_size=args.cache_size)
+    results["lru_cold"] = lookups_per_second(live.lookup, queries, 1)
+    results["lru_warm"] = lookups_per_second(live.lookup, queries, args.repeats)
+    if args.index:
+        mapped = SynonymIndex(args.index, cache_size=args.cache_size)
+        results["mmap_cold"] = lookups_per_second(mapped.lookup, queries, 1)
+        results["mmap_warm"] = lookups_per_second(mapped.lookup, queries, args.repeats)
+        results["mmap_hit_rate"] = 1 - len([w for w in set(words) if mapped._index.get(w.lower()) is None]) / len(set(words))
+    for name, value in results.items():
+        print(f"{name:>14}: {value:,.2f}" if isinstance(value, float) else f"{name:>14}: {value}")
+    return results
+
+
+def bench_pages(args):
+    random.seed(args.seed)
+    documents = example_documents(args.examples_dir)
+    rand_aug = build_augmenter(args)
+    n_pages = 0
+    with AugmentationPool(rand_aug, args.aug_processes) as pool:
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            for key, tiff_bytes, metadata in documents:
+                image = Image.open(io.BytesIO(tiff_bytes))
+                mask_and_replace_text(image, json.loads(json.dumps(metadata)), args.font_path, rand_aug, pool, args.page_threads,
+                                      RenderConfig(mode=args.render_mode))
+                n_pages += len(metadata['pages'])
+        elapsed = time.perf_counter() - start
+    rand_aug.close()
+    results = {"pages": n_pages, "seconds": elapsed, "pages_per_sec": n_pages / elapsed}
+    print(f"{n_pages} pages in {elapsed:.2f}s: {n_pages / elapsed:.3f} pages/sec "
+          f"(aug_processes={args.aug_processes}, page_threads={args.page_threads}, render_mode={args.render_mode})")
+    return results
+
+
+def bench_variants(args):
+    """Documents/sec and variants/sec of mask_and_replace_text for each variant count, decode and tagging included."""
+    documents = example_documents(args.examples_dir)
+    rand_aug = build_augmenter(args)
+    results = []
+    with AugmentationPool(rand_aug, args.aug_processes) as pool:
+        # one untimed pass fills the font and synonym caches, otherwise the first K pays for them
+        for key, tiff_bytes, metadata in documents:
+            mask_and_replace_text(Image.open(io.BytesIO(tiff_bytes)), json.loads(json.dumps(metadata)), args.font_path, rand_aug, pool,
+                                  args.page_threads, n_variants=1)
+        for n_variants in args.n_variants:
+            random.seed(args.seed)
+            start = time.perf_counter()
+            for _ in range(args.repeats):
+                for key, tiff_bytes, metadata in documents:
+                    image = Image.open(io.BytesIO(tiff_bytes))
+                    mask_and_replace_text(image, json.loads(json.dumps(metadata)), args.font_path, rand_aug, pool, args.page_threads,
+                                          n_variants=n_variants)
+            elapsed = time.perf_counter() - start
+            n_documents = args.repeats * len(documents)
+            results.append({"n_variants": n_variants, "documents": n_documents, "seconds": elapsed,
+                            "documents_per_sec": n_documents / elapsed, "variants_per_sec": n_documents * n_variants / elapsed})
+            print(f"K={n_variants}: {n_documents / elapsed:.3f} documents/sec, {n_documents * n_variants / elapsed:.3f} variants/sec")
+    rand_aug.close()
+    return results
+
+
+def bench_ops(args):
+    """Lines/sec of TextAugmenter.random_aug for each op over the lines of the example documents, tags computed beforehand."""
+    rand_aug = build_augmenter(args)
+    lines = example_lines(args.examples_dir)
+    # keyword replacement only ever gets lines over 50 characters, see pick_choices
+    inputs = {op: [line for line in lines if len(line) > 50] if op == "kreplacement" else lines for op in args.ops}
+    tagged_lines = dict(zip(inputs.get("kreplacement", []), rand_aug.tag_batch(inputs.get("kreplacement", []))))
+    results = {}
+    for op in args.ops:
+        random.seed(args.seed)
+        for line in inputs[op]:  # untimed pass that fills the synonym cache
+            rand_aug.random_aug(line, 0.10, op, tagged_lines.get(line))
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            if args.batch:
+                rand_aug.augment_batch(inputs[op], 0.10, [op] * len(inputs[op]), tagged_lines=tagged_lines)
+                continue
+            for line in inputs[op]:
+                rand_aug.random_aug(line, 0.10, op, tagged_lines.get(line))
+        elapsed = time.perf_counter() - start
+        n_lines = args.repeats * len(inputs[op])
+        results[op] = {"lines": n_lines, "seconds": elapsed, "lines_per_sec": n_lines / elapsed}
+        print(f"{op:>13}: {n_lines / elapsed:12,.0f} lines/sec ({len(inputs[op])} lines x {args.repeats})")
+    rand_aug.close()
+    return results
+
+
+def bench_backend(args):
+    """
+    Lines/sec of LocalModelBackend with the stand-in model, which costs --batch_ms per forward pass plus --line_ms
+    per line, when --threads page threads augment pages of --page_lines lines at once, per batch size / latency bound.
+    """
+    lines = example_lines(args.examples_dir)
+    results = []
+    for max_batch_size in args.max_batch_sizes:
+        for max_latency_ms in args.max_latencies_ms:
+            backend = LocalModelBackend(max_batch_size=max_batch_size, max_latency=max_latency_ms / 1000,
+                                        generator_factory=partial(StandInGenerator, args.batch_ms / 1000, args.line_ms / 1000))
+            backend.augment_batch(lines[:1], 0.10, ["swap"])  # loads the model
+            METRICS.reset()
+
+            def augment_pages(thread: int):
+                rng = random.Random(args.seed + thread)
+                for _ in range(args.pages):
+                    page_lines = rng.sample(lines, min(args.page_lines, len(lines)))
+                    backend.augment_batch(page_lines, 0.10, [rng.choice(AUG_CHOICES) for _ in page_lines], rng)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.threads) as executor:
+                list(executor.map(augment_pages, range(args.threads)))
+            elapsed = time.perf_counter() - start
+            backend.close()
+            counters = METRICS.report()["counters"]
+            n_lines = counters.get("model_lines", 0)
+            mean_batch = n_lines / max(counters.get("model_batches", 1), 1)
+            results.append({"max_batch_size": max_batch_size, "max_latency_ms": max_latency_ms, "lines": n_lines, "seconds": elapsed,
+                            "lines_per_sec": n_lines / elapsed, "mean_batch_size": mean_batch})
+            print(f"batch<={max_batch_size:3d} latency<={max_latency_ms:5.1f}ms: {n_lines / elapsed:8,.0f} lines/sec, mean batch {mean_batch:5.1f}")
+    return results
+
+
+def bench_render(args):
+    """Time to draw the new text of 40% of the lines of synthetic pages, per page size and line count, for both render modes."""
+    rng = random.Random(args.seed)
+    results = []
+    for size in args.sizes:
+        for n_lines in args.lines:
+            page, annotation = synthetic_page(rng, parse_size(size), n_lines, args.font_path)
+            selected = rng.sample(range(n_lines), max(1, int(0.4 * n_lines)))
+            new_texts = [' '.join(reversed(annotation['text'][i].split())) for i in selected]
+            timings = {}
+            for mode in ("patch", "full"):
+                config = RenderConfig(mode=mode)
+                start = time.perf_counter()
+                for _ in range(args.repeats):
+                    page_copy = json.loads(json.dumps(annotation))
+                    if mode == "patch":
+                        render_text_patches(page, page_copy, selected, new_texts, args.font_path, config)[0].compose()
+                    else:
+                        render_text_section(page.copy(), page_copy, selected, new_texts, args.font_path, config)
+                timings[mode] = (time.perf_counter() - start) / args.repeats
+            results.append({"size": size, "lines": n_lines, "rendered_lines": len(selected),
+                            "patch_ms_per_page": 1000 * timings["patch"], "full_ms_per_page": 1000 * timings["full"]})
+            print(f"{size:>10} {n_lines:4d} lines: patch {1000 * timings['patch']:7.1f} ms/page, full {1000 * timings['full']:7.1f} ms/page")
+    return results
+
+
+def bench_e2e(args):
+    """process_shards on one generated shard: synthetic documents, or copies of the examples with --copies."""
+    work_dir = tempfile.mkdtemp(prefix="bench_e2e_")
+    try:
+        tar_path = os.path.join(work_dir, "bench-000000.tar")
+        if args.copies:
+            import tarfile
+            with tarfile.open(tar_path, 'w') as tar:
+                for copy in range(args.copies):
+                    for key, tiff_bytes, metadata in example_documents(args.examples_dir):
+                        for extension, data in (("tif", tiff_bytes), ("json", json.dumps(metadata).encode('utf-8'))):
+                            info = tarfile.TarInfo(f"{key}c{copy:04d}.{extension}")
+                            info.size = len(data)
+                            tar.addfile(info, io.BytesIO(data))
+        else:
+            write_synthetic_shard(tar_path, args.documents, args.pages, args.lines, parse_size(args.size), args.font_path, seed=args.seed)
+        rand_aug = build_augmenter(args)
+        random.seed(args.seed)
+        METRICS.reset()
+        totals = process_shards([tar_path], os.path.join(work_dir, "out"), args.workers, ParallelConfig(page_threads=args.page_threads),
+                                args.font_path, rand_aug, max_in_flight=args.max_in_flight, n_variants=args.n_variants)
+        rand_aug.close()
+    finally:
+        shutil.rmtree(work_dir)
+    print(f"{totals['documents']} documents, {totals['pages']} pages in {totals['seconds']:.2f}s: "
+          f"{totals['documents_per_sec']:.3f} documents/sec, {totals['pages_per_sec']:.3f} pages/sec")
+    return {"totals": totals, "metrics": METRICS.report()}
+
+
+def bench_cache(args):
+    """
+    process_shards on a synthetic shard where --boilerplate_fraction of the lines repeat from --boilerplate_lines fixed
+    lines: without caches, with the line and patch caches in memory, and with an on-disk store, empty and then warm.
+    """
+    work_dir = tempfile.mkdtemp(prefix="bench_cache_")
+    results = {}
+    try:
+        tar_path = os.path.join(work_dir, "bench-000000.tar")
+        write_synthetic_shard(tar_path, args.documents, args.pages, args.lines, parse_size(args.size), args.font_path, seed=args.seed,
+                              boilerplate=boilerplate_lines(args.boilerplate_lines, args.seed), boilerplate_fraction=args.boilerplate_fraction)
+        rand_aug = build_augmenter(args)
+        cache_dir = os.path.join(work_dir, "cache")
+        for name, cached, disk_dir in (("off", False, None), ("memory", True, None), ("disk_cold", True, cache_dir), ("disk_warm", True, cache_dir)):
+            line_cache, patch_cache = build_caches(args.line_cache_size, args.patch_cache_mb, disk_dir) if cached else (None, None)
+            METRICS.reset()
+            totals = process_shards([tar_path], os.path.join(work_dir, f"out_{name}"), args.workers, ParallelConfig(page_threads=args.page_threads),
+                                    args.font_path, rand_aug, render_config=RenderConfig(line_cache=line_cache, patch_cache=patch_cache),
+                                    n_variants=args.n_variants, seed=args.seed)
+            report = METRICS.report()
+            lines_augmented = report["counters"].get("lines_augmented", 0)
+            # without the patch cache every augmented line is rendered, with it only the misses
+            lines_rendered = report["stages"].get("text_mask", {}).get("count", 0) if patch_cache is not None else lines_augmented
+            results[name] = {"totals": totals, "hit_rates": report["hit_rates"], "lines_augmented": lines_augmented,
+                             "lines_tagged": report["counters"].get("lines_tagged", 0), "lines_rendered": lines_rendered}
+            hit_rates = ", ".join(f"{cache} {rate:.1%}" for cache, rate in report["hit_rates"].items() if cache in ("line_cache", "patch_cache"))
+            print(f"{name:10s} {totals['pages_per_sec']:7.3f} pages/sec, {lines_augmented} lines: {results[name]['lines_tagged']:5d} tagged, "
+                  f"{lines_rendered:5d} rendered{', hit rates ' + hit_rates if hit_rates else ''}")
+        rand_aug.close()
+    finally:
+        shutil.rmtree(work_dir)
+    return results
+
+
+def bench_synthetic(args):
+    """Not a benchmark: writes a synthetic shard, e.g. as --shards input of augment_idl_shards_util.py."""
+    keys = write_synthetic_shard(args.tar_path, args.documents, args.pages, args.lines, parse_size(args.size), args.font_path, seed=args.seed)
+    print(f"Wrote {len(keys)} documents to {args.tar_path}")
+    return {"tar_path": args.tar_path, "documents": len(keys)}
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_document_rss(args):
+    """Runs one document in this process and prints the growth of the peak RSS as JSON."""
+    random.seed(args.seed)
+    key, tiff_bytes, metadata = next(doc for doc in example_documents(args.examples_dir) if doc[0] == args.document)
+    rand_aug = build_augmenter(args)
+    wordnet_synonyms("warm")  # load WordNet before the baseline is taken, words missing from an index still need it
+    baseline = peak_rss_mb()
+    image = Image.open(io.BytesIO(tiff_bytes))
+    budget = MemoryBudget(int(args.memory_budget_mb * 2 ** 20) if args.memory_budget_mb else None)
+    mask_and_replace_text(image, metadata, args.font_path, rand_aug, None, args.page_threads, RenderConfig(mode=args.render_mode),
+                          memory_budget=budget)
+    result = {"document": key, "render_mode": args.render_mode, "pages": len(metadata['pages']), "budget_peak_mb": budget.peak / 2 ** 20,
+              "baseline_mb": baseline, "peak_mb": peak_rss_mb(), "document_mb": peak_rss_mb() - baseline}
+    print(json.dumps(result))
+    return result
+
+
+def bench_memory(args):
+    """Peak memory per example document and render mode, each measured in a fresh process."""
+    results = []
+    for key, _, _ in example_documents(args.examples_dir):
+        for render_mode in args.render_modes:
+            command = [sys.executable, os.path.abspath(__file__), "--examples_dir", args.examples_dir, "document_rss",
+                       "--document", key, "--render_mode", render_mode, "--page_threads", str(args.page_threads)]
+            if args.memory_budget_mb:
+                command += ["--memory_budget_mb", str(args.memory_budget_mb)]
+            for name in ("stopwords_path", "synonym_index"):
+                if getattr(args, name):
+                    command += [f"--{name}", getattr(args, name)]
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+            print(f"{key:>10} {render_mode:>6}: {results[-1]['document_mb']:8.1f} MB above baseline "
+                  f"({results[-1]['pages']} pages)")
+    return results
+
+
+def bench_encode(args):
+    """Encodes 3 versions of every example document, as at the end of mask_and_replace_text."""
+    documents = []
+    for key, tiff_bytes, _ in example_documents(args.examples_dir):
+        image = Image.open(io.BytesIO(tiff_bytes))
+        pages = []
+        for i in range(getattr(image, "n_frames", 1)):
+            image.seek(i)
+            pages.append(image.copy())
+        documents.append([pages, [page.copy() for page in pages], [page.copy() for page in pages]])
+    results = []
+    for codec in args.codecs:
+        for workers in args.workers:
+            config = EncodeConfig(codec=codec, deflate_level=args.deflate_level, workers=workers)
+            start = time.perf_counter()
+            n_bytes = 0
+            for _ in range(args.repeats):
+                for versions in documents:
+                    with ThreadPoolExecutor(max_workers=workers) as executor:
+                        n_bytes += sum(len(tiff.getvalue()) for tiff in executor.map(lambda pages: create_in_memory_tiff(pages, config), versions))
+            elapsed = time.perf_counter() - start
+            results.append({"codec": codec, "deflate_level": args.deflate_level, "workers": workers,
+                            "seconds": elapsed, "mb": n_bytes / args.repeats / 2 ** 20})
+            print(f"{codec:>12} level={args.deflate_level} workers={workers}: {elapsed:6.2f}s, {results[-1]['mb']:6.2f} MB")
+    return results
+
+
+def add_augmenter_arguments(parser):
+    parser.add_argument("--stopwords_path", type=str, default=None, help="Stopwords file, a small built-in list is used if not given.")
+    parser.add_argument("--pos_backend", type=str, default="rule", choices=["stanford", "rule", "stub"], help="POS tagger used for keyword replacement, stub tags every token NN.")
+    parser.add_argument("--pos_model_path", type=str, default=None, help="Path to the Stanford POS tagger model file.")
+    parser.add_argument("--pos_jar_path", type=str, default=None, help="Path to the Stanford POS tagger jar file.")
+    parser.add_argument("--synonym_index", type=str, default=None, help="Prebuilt synonym index, live WordNet if not given.")
+    parser.add_argument("--font_path", type=str, default=FONT_PATH, help="Font used to render the new text.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the global random module.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the augmentation pipeline.")
+    parser.add_argument("--examples_dir", type=str, default=EXAMPLES_DIR, help="Directory with the original .tif/.json pairs.")
+    parser.add_argument("--output", type=str, default=None, help="Also write the results, the arguments and the machine to this JSON file.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    synonyms_parser = subparsers.add_parser("synonyms", help="Synonym lookups per second: uncached WordNet vs the LRU cache vs a prebuilt index.")
+    synonyms_parser.add_argument("--index", type=str, default=None, help="Index file built with synonym_index.py, benchmarked if given.")
+    synonyms_parser.add_argument("--cache_size", type=int, default=200_000, help="LRU cache size.")
+    synonyms_parser.add_argument("--repeats", type=int, default=5, help="Passes over the queries for the warm-cache numbers.")
+    synonyms_parser.set_defaults(func=bench_synonyms)
+
+    pages_parser = subparsers.add_parser("pages", help="Pages/sec of mask_and_replace_text over the example documents.")
+    add_augmenter_arguments(pages_parser)
+    pages_parser.add_argument("--aug_processes", type=int, default=3, help="Size of the shared augmentation pool.")
+    pages_parser.add_argument("--page_threads", type=int, default=3, help="Pages of a document processed at once.")
+    pages_parser.add_argument("--repeats", type=int, default=1, help="Passes over the example documents.")
+    pages_parser.add_argument("--render_mode", type=str, default="patch", choices=["patch", "full"], help="How page versions are rendered.")
+    pages_parser.set_defaults(func=bench_pages)
+
+    variants_parser = subparsers.add_parser("variants", help="Documents/sec and variants/sec over the example documents for several variant counts.")
+    add_augmenter_arguments(variants_parser)
+    variants_parser.add_argument("--n_variants", type=int, nargs="+", default=[1, 3, 8], help="Variant counts to compare.")
+    variants_parser.add_argument("--aug_processes", type=int, default=0, help="Size of the shared augmentation pool.")
+    variants_parser.add_argument("--page_threads", type=int, default=3, help="Pages of a document processed at once.")
+    variants_parser.add_argument("--repeats", type=int, default=1, help="Passes over the example documents.")
+    variants_parser.set_defaults(func=bench_variants)
+
+    memory_parser = subparsers.add_parser("memory", help="Peak RSS per example document for each render mode.")
+    add_augmenter_arguments(memory_parser)
+    memory_parser.add_argument("--render_modes", type=str, nargs="+", default=["full", "patch"], help="Render modes to compare.")
+    memory_parser.add_argument("--page_threads", type=int, default=3, help="Pages of a document processed at once.")
+    memory_parser.add_argument("--memory_budget_mb", type=float, default=None, help="Memory budget of the document's pages in flight, in MB.")
+    memory_parser.set_defaults(func=bench_memory)
+
+    encode_parser = subparsers.add_parser("encode", help="TIFF encoding time and size of 3 versions per example document.")
+    encode_parser.add_argument("--codecs", type=str, nargs="+", default=["tiff_deflate", "group4"], choices=CODECS)
+    encode_parser.add_argument("--deflate_level", type=int, default=None, help="zlib level for tiff_deflate, libtiff's default if not given.")
+    encode_parser.add_argument("--workers", type=int, nargs="+", default=[1, 3], help="Versions encoded at once.")
+    encode_parser.add_argument("--repeats", type=int, default=1)
+    encode_parser.set_defaults(func=bench_encode)
+
+    ops_parser = subparsers.add_parser("ops", help="Lines/sec of each augmentation op over the example lines.")
+    add_augmenter_arguments(ops_parser)
+    ops_parser.set_defaults(pos_backend="stub")
+    ops_parser.add_argument("--ops", type=str, nargs="+", default=AUG_CHOICES, choices=AUG_CHOICES)
+    ops_parser.add_argument("--repeats", type=int, default=3, help="Timed passes over the lines.")
+    ops_parser.add_argument("--batch", action="store_true", help="One TextAugmenter.augment_batch call per pass instead of random_aug per line.")
+    ops_parser.set_defaults(func=bench_ops)
+
+    backend_parser = subparsers.add_parser("backend", help="Lines/sec of the batched local model backend with the stand-in model.")
+    backend_parser.add_argument("--threads", type=int, default=6, help="Threads augmenting pages at once, like page threads of several documents.")
+    backend_parser.add_argument("--pages", type=int, default=20, help="Pages per thread.")
+    backend_parser.add_argument("--page_lines", type=int, default=16, help="Lines augmented per page.")
+    backend_parser.add_argument("--max_batch_sizes", type=int, nargs="+", default=[1, 8, 32, 128], help="Batch sizes to compare, 1 is unbatched.")
+    backend_parser.add_argument("--max_latencies_ms", type=float, nargs="+", default=[5.0, 50.0], help="Latency bounds to compare.")
+    backend_parser.add_argument("--batch_ms", type=float, default=20.0, help="Simulated cost of a forward pass.")
+    backend_parser.add_argument("--line_ms", type=float, default=0.5, help="Simulated cost per line of a forward pass.")
+    backend_parser.add_argument("--seed", type=int, default=0)
+    backend_parser.set_defaults(func=bench_backend)
+
+    render_parser = subparsers.add_parser("render", help="ms/page to render the modified lines of synthetic pages, patch vs full mode.")
+    render_parser.add_argument("--sizes", type=str, nargs="+", default=["1275x1650", "2550x3300"], help="Page sizes, WIDTHxHEIGHT.")
+    render_parser.add_argument("--lines", type=int, nargs="+", default=[20, 50, 100], help="Lines per page.")
+    render_parser.add_argument("--repeats", type=int, default=3)
+    render_parser.add_argument("--font_path", type=str, default=FONT_PATH)
+    render_parser.add_argument("--seed", type=int, default=0)
+    render_parser.set_defaults(func=bench_render)
+
+    e2e_parser = subparsers.add_parser("e2e", help="End to end over a generated shard with the multi-process driver, stage metrics included.")
+    add_augmenter_arguments(e2e_parser)
+    e2e_parser.add_argument("--documents", type=int, default=8, help="Synthetic documents in the shard.")
+    e2e_parser.add_argument("--pages", type=int, default=3, help="Pages per synthetic document.")
+    e2e_parser.add_argument("--lines", type=int, default=40, help="Lines per synthetic page.")
+    e2e_parser.add_argument("--size", type=str, default="2550x3300", help="Synthetic page size, WIDTHxHEIGHT.")
+    e2e_parser.add_argument("--copies", type=int, default=0, help="Use this many copies of the example documents instead of synthetic ones.")
+    e2e_parser.add_argument("--workers", type=int, default=2, help="Worker processes.")
+    e2e_parser.add_argument("--page_threads", type=int, default=3, help="Pages of a document processed at once.")
+    e2e_parser.add_argument("--max_in_flight", type=int, default=8)
+    e2e_parser.add_argument("--n_variants", type=int, default=3)
+    e2e_parser.set_defaults(func=bench_e2e)
+
+    cache_parser = subparsers.add_parser("cache", help="End to end over a shard of repeated boilerplate lines, without and with the line and patch caches.")
+    add_augmenter_arguments(cache_parser)
+    cache_parser.add_argument("--documents", type=int, default=8, help="Synthetic documents in the shard.")
+    cache_parser.add_argument("--pages", type=int, default=3, help="Pages per synthetic document.")
+    cache_parser.add_argument("--lines", type=int, default=40, help="Lines per synthetic page.")
+    cache_parser.add_argument("--size", type=str, default="2550x3300", help="Synthetic page size, WIDTHxHEIGHT.")
+    cache_parser.add_argument("--boilerplate_lines", type=int, default=30, help="Fixed lines the pages repeat.")
+    cache_parser.add_argument("--boilerplate_fraction", type=float, default=0.5, help="Share of the lines picked from the fixed lines.")
+    cache_parser.add_argument("--line_cache_size", type=int, default=100_000, help="Augmented lines kept per process.")
+    cache_parser.add_argument("--patch_cache_mb", type=float, default=256, help="MB of rendered text kept per process.")
+    cache_parser.add_argument("--workers", type=int, default=2, help="Worker processes.")
+    cache_parser.add_argument("--page_threads", type=int, default=3, help="Pages of a document processed at once.")
+    cache_parser.add_argument("--n_variants", type=int, default=3)
+    cache_parser.set_defaults(func=bench_cache)
+
+    synthetic_parser = subparsers.add_parser("synthetic", help="Write a synthetic shard.")
+    synthetic_parser.add_argument("tar_path", type=str)
+    synthetic_parser.add_argument("--documents", type=int, default=100)
+    synthetic_parser.add_argument("--pages", type=int, default=3)
+    synthetic_parser.add_argument("--lines", type=int, default=40)
+    synthetic_parser.add_argument("--size", type=str, default="2550x3300", help="WIDTHxHEIGHT.")
+    synthetic_parser.add_argument("--font_path", type=str, default=FONT_PATH)
+    synthetic_parser.add_argument("--seed", type=int, default=0)
+    synthetic_parser.set_defaults(func=bench_synthetic)
+
+    document_rss_parser = subparsers.add_parser("document_rss", help="Used by `memory`: one document in this process.")
+    add_augmenter_arguments(document_rss_parser)
+    document_rss_parser.add_argument("--document", type=str, required=True, help="Key of the example document.")
+    document_rss_parser.add_argument("--render_mode", type=str, default="patch", choices=["patch", "full"])
+    document_rss_parser.add_argument("--page_threads", type=int, default=3)
+    document_rss_parser.add_argument("--memory_budget_mb", type=float, default=None)
+    document_rss_parser.set_defaults(func=bench_document_rss)
+
+    args = parser.parse_args()
+    results = args.func(args)
+    if args.output:
+        run = {"command": args.command, "time": datetime.now().isoformat(timespec="seconds"),
+               "args": {name: value for name, value in vars(args).items() if name != "func"},
+               "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+               "results": results}
+        with open(args.output, 'w') as output_file:
+            json.dump(run, output_file, indent=2)
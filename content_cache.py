@@ -0,0 +1,158 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+from instrumentation import count
+
+_logger = logging.getLogger('endless_attempts')
+
+# puts between two evictions of the on-disk store
+_DISK_EVICT_EVERY = 1024
+
+
+def _identity(value):
+    return value
+
+
+class ContentCache:
+    """
+    LRU cache of values by content key (a tuple of str / numbers), for work that repeats across the lines,
+    pages and documents of a run. The least recently used entries are dropped once there are more than
+    max_entries of them or their sizeof adds up to more than max_bytes.
+
+    With disk_path, misses also look in a SQLite file that every worker process on the node can share, and new
+    entries are written to it (encode / decode convert values to and from bytes). Its rows are evicted the same
+    way past disk_entries. A busy or broken file only costs hits: errors are counted and the lookup is a miss.
+
+    A copy sent to another process starts with an empty memory and opens the file itself. Lookups are counted
+    as <name>_lookups, and as <name>_hits, <name>_disk_hits or <name>_misses; Metrics.report adds the hit rates.
+    """
+
+    def __init__(self, name: str, max_entries: Optional[int] = None, max_bytes: Optional[int] = None,
+                 disk_path: Optional[str] = None, disk_entries: int = 1_000_000, sizeof: Callable[[Any], int] = len,
+                 encode: Callable[[Any], bytes] = _identity, decode: Callable[[bytes], Any] = _identity):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_path = disk_path
+        self.disk_entries = disk_entries
+        self.sizeof = sizeof
+        self.encode = encode
+        self.decode = decode
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk = None
+        self._disk_pid = None
+        self._disk_lock = threading.Lock()
+        self._puts = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        count(f"{self.name}_lookups")
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+        if value is not None:
+            count(f"{self.name}_hits")
+            return value
+        if self.disk_path is not None:
+            data = self._disk_get(key)
+            if data is not None:
+                value = self.decode(data)
+                self._remember(key, value)
+                count(f"{self.name}_disk_hits")
+                return value
+        count(f"{self.name}_misses")
+        return None
+
+    def put(self, key: Hashable, value: Any):
+        self._remember(key, value)
+        if self.disk_path is not None:
+            self._disk_put(key, self.encode(value))
+
+    def _remember(self, key: Hashable, value: Any):
+        size = self.sizeof(value)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= self.sizeof(old)
+            self._entries[key] = value
+            self._bytes += size
+            while self._entries and ((self.max_entries is not None and len(self._entries) > self.max_entries)
+                                     or (self.max_bytes is not None and self._bytes > self.max_bytes)):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= self.sizeof(evicted)
+
+    @staticmethod
+    def _disk_key(key: Hashable) -> str:
+        return hashlib.blake2b(repr(key).encode('utf-8'), digest_size=16).hexdigest()
+
+    def _connection(self) -> sqlite3.Connection:
+        # a forked worker inherits the object but must not use its parent's connection
+        if self._disk is None or self._disk_pid != os.getpid():
+            directory = os.path.dirname(self.disk_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.disk_path, timeout=1.0, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # entries can always be recomputed, losing the last ones in a crash is fine
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, used REAL)")
+            self._disk, self._disk_pid = connection, os.getpid()
+        return self._disk
+
+    def _disk_get(self, key: Hashable) -> Optional[bytes]:
+        disk_key = self._disk_key(key)
+        try:
+            with self._disk_lock:
+                connection = self._connection()
+                row = connection.execute("SELECT value FROM entries WHERE key = ?", (disk_key,)).fetchone()
+                if row is not None:
+                    connection.execute("UPDATE entries SET used = ? WHERE key = ?", (time.time(), disk_key))
+        except (sqlite3.Error, OSError) as e:
+            self._disk_error(e)
+            return None
+        return row[0] if row is not None else None
+
+    def _disk_put(self, key: Hashable, data: bytes):
+        try:
+            with self._disk_lock:
+                connection = self._connection()
+                connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (self._disk_key(key), data, time.time()))
+                self._puts += 1
+                if self._puts % _DISK_EVICT_EVERY == 0:
+                    (n,) = connection.execute("SELECT COUNT(*) FROM entries").fetchone()
+                    if n > self.disk_entries:
+                        connection.execute("DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY used LIMIT ?)",
+                                           (n - self.disk_entries,))
+        except (sqlite3.Error, OSError) as e:
+            self._disk_error(e)
+
+    def _disk_error(self, error: Exception):
+        count(f"{self.name}_disk_errors")
+        _logger.debug(f"Cache {self.name} could not use {self.disk_path}: {error}")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_entries=OrderedDict(), _bytes=0, _disk=None, _disk_pid=None, _puts=0)
+        del state['_lock'], state['_disk_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
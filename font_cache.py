@@ -0,0 +1,69 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Tuple
+
+from PIL import ImageFont
+
+# size at which glyph advances are measured once; widths at other sizes are scaled linearly from it
+_REFERENCE_SIZE = 1000
+
+
+class FontCache:
+    """
+    LRU cache of loaded FreeType fonts keyed by (path, size), shared by every line, page and version
+    rendered in the process, so a font file is parsed once per size instead of once per line.
+    """
+
+    def __init__(self, max_fonts: int = 256):
+        self.max_fonts = max_fonts
+        self._fonts: "OrderedDict[Tuple[str, int], ImageFont.FreeTypeFont]" = OrderedDict()
+        self._advances: Dict[Tuple[str, str], float] = {}
+        self._lock = Lock()
+
+    def get(self, font_path: str, size: int) -> ImageFont.FreeTypeFont:
+        key = (font_path, size)
+        with self._lock:
+            font = self._fonts.get(key)
+            if font is not None:
+                self._fonts.move_to_end(key)
+                return font
+        font = ImageFont.truetype(font_path, size)
+        with self._lock:
+            self._fonts[key] = font
+            self._fonts.move_to_end(key)
+            while len(self._fonts) > self.max_fonts:
+                self._fonts.popitem(last=False)
+        return font
+
+    def text_width(self, font_path: str, text: str, size: int) -> float:
+        """Width of `text` at `size`, from per-glyph advances measured once at the reference size (no kerning)."""
+        advances = self._advances
+        missing = [char for char in set(text) if (font_path, char) not in advances]
+        if missing:
+            reference = self.get(font_path, _REFERENCE_SIZE)
+            for char in missing:
+                advances[(font_path, char)] = reference.getlength(char)
+        return sum(advances[(font_path, char)] for char in text) * size / _REFERENCE_SIZE
+
+    def fitted_size(self, font_path: str, text: str, box_width: float, box_height: float, height_ratio: float = 0.90) -> int:
+        """Largest size up to height_ratio * box_height at which `text` fits into box_width."""
+        size = int(height_ratio * box_height)
+        width = self.text_width(font_path, text, size) if size > 0 else 0
+        if width > box_width:
+            size = int(size * box_width / width)
+        return max(size, 1)
+
+    def __getstate__(self):
+        # fonts are not picklable, a copy sent to another process starts empty
+        return {'max_fonts': self.max_fonts}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_fonts'])
+
+    def clear(self):
+        with self._lock:
+            self._fonts.clear()
+            self._advances.clear()
+
+
+FONT_CACHE = FontCache()
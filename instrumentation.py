@@ -0,0 +1,155 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+_logger = logging.getLogger('endless_attempts')
+
+
+class Metrics:
+    """
+    Thread-safe timers and counters of the pipeline stages.
+
+    Every process has its own registry (METRICS). Worker processes hand their numbers to the
+    parent with drain(), which returns a plain dict and starts over, and the parent adds them
+    to its own with merge(), so each event is counted exactly once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timers: Dict[str, list] = {}
+        self._counters: Dict[str, int] = {}
+        self.started = time.time()
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage: str, seconds: float, count: int = 1):
+        with self._lock:
+            timer = self._timers.get(stage)
+            if timer is None:
+                self._timers[stage] = [count, seconds, seconds]
+            else:
+                timer[0] += count
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"timers": {stage: list(timer) for stage, timer in self._timers.items()}, "counters": dict(self._counters)}
+
+    def drain(self) -> Dict[str, Any]:
+        with self._lock:
+            snapshot = {"timers": self._timers, "counters": self._counters}
+            self._timers, self._counters = {}, {}
+        return snapshot
+
+    def merge(self, snapshot: Optional[Dict[str, Any]]):
+        if not snapshot:
+            return
+        with self._lock:
+            for stage, (count, seconds, longest) in snapshot["timers"].items():
+                timer = self._timers.setdefault(stage, [0, 0.0, 0.0])
+                timer[0] += count
+                timer[1] += seconds
+                timer[2] = max(timer[2], longest)
+            for name, n in snapshot["counters"].items():
+                self._counters[name] = self._counters.get(name, 0) + n
+
+    def reset(self):
+        with self._lock:
+            self._timers, self._counters = {}, {}
+            self.started = time.time()
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Machine-readable totals: per stage count, total / mean / max seconds, counters and counters per second,
+        and the hit rate of every cache that counts <name>_lookups (see ContentCache).
+        """
+        snapshot = self.snapshot()
+        elapsed = time.time() - self.started
+        stages = {stage: {"count": count, "total_seconds": seconds, "mean_seconds": seconds / count if count else 0.0, "max_seconds": longest}
+                  for stage, (count, seconds, longest) in sorted(snapshot["timers"].items())}
+        counters = dict(sorted(snapshot["counters"].items()))
+        hit_rates = {}
+        for name, n in counters.items():
+            if name.endswith("_lookups") and n:
+                cache = name[:-len("_lookups")]
+                hit_rates[cache] = (counters.get(f"{cache}_hits", 0) + counters.get(f"{cache}_disk_hits", 0)) / n
+        return {"elapsed_seconds": elapsed, "stages": stages, "counters": counters,
+                "per_second": {name: n / elapsed for name, n in counters.items()} if elapsed > 0 else {},
+                "hit_rates": hit_rates}
+
+    def summary(self) -> str:
+        """One line for the log: counters, then stages by total time."""
+        report = self.report()
+        counters = ", ".join(f"{name}={n}" for name, n in report["counters"].items())
+        hit_rates = "".join(f", {cache} hit rate {rate:.1%}" for cache, rate in report["hit_rates"].items())
+        stages = ", ".join(f"{stage} {values['total_seconds']:.1f}s/{values['count']}"
+                           for stage, values in sorted(report["stages"].items(), key=lambda item: -item[1]["total_seconds"]))
+        return f"[{report['elapsed_seconds']:.0f}s] {counters}{hit_rates} | {stages}"
+
+
+METRICS = Metrics()
+
+
+def timed(stage: str):
+    return METRICS.timer(stage)
+
+
+def count(name: str, n: int = 1):
+    METRICS.count(name, n)
+
+
+def reset_metrics():
+    """Process pool initializer: a forked worker must not report the numbers it inherited from its parent."""
+    METRICS.reset()
+
+
+class MetricsReporter:
+    """Logs METRICS.summary() every `interval` seconds until stopped, then the final report as JSON."""
+
+    def __init__(self, interval: float = 60.0, report_path: Optional[str] = None, metrics: Metrics = METRICS):
+        self.interval = interval
+        self.report_path = report_path
+        self.metrics = metrics
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name="metrics-reporter", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            _logger.info(f"Progress: {self.metrics.summary()}")
+
+    def stop(self) -> Dict[str, Any]:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        report = self.metrics.report()
+        _logger.info(f"Metrics report: {json.dumps(report)}")
+        if self.report_path:
+            with open(self.report_path, 'w') as report_file:
+                json.dump(report, report_file, indent=2)
+        return report
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
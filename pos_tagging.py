@@ -0,0 +1,172 @@
+import re
+import subprocess
+import threading
+from typing import List, Optional, Sequence, Tuple
+
+TaggedLine = List[Tuple[str, str]]
+
+
+class POSTagger:
+    """Common interface of the tagging backends: tokens in, (token, Penn tag) pairs out."""
+
+    def tag(self, tokens: Sequence[str]) -> TaggedLine:
+        return self.tag_batch([tokens])[0]
+
+    def tag_batch(self, lines: Sequence[Sequence[str]]) -> List[TaggedLine]:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class StanfordTaggerEngine(POSTagger):
+    """
+    Stanford MaxentTagger kept alive for the lifetime of the object.
+
+    nltk's StanfordPOSTagger starts a new JVM for every call; here a single JVM reads
+    whitespace-tokenized sentences from stdin (one per line) and answers with one tagged
+    line per sentence, so the model is loaded once per process. The JVM is started lazily
+    and is not pickled, so forked / spawned workers start their own on first use.
+    """
+    _SEPARATOR = '_'
+
+    def __init__(self, model_path: str, jar_path: str, java_options: str = "-mx4000m", java_bin: str = "java"):
+        self.model_path = model_path
+        self.jar_path = jar_path
+        self.java_options = java_options
+        self.java_bin = java_bin
+        self._proc = None
+        self._lock = threading.Lock()
+
+    def _command(self) -> List[str]:
+        return [self.java_bin, *self.java_options.split(), "-cp", self.jar_path,
+                "edu.stanford.nlp.tagger.maxent.MaxentTagger",
+                "-model", self.model_path,
+                "-tokenize", "false",
+                "-sentenceDelimiter", "newline",
+                "-outputFormat", "slashTags",
+                "-tagSeparator", self._SEPARATOR,
+                "-encoding", "utf8"]
+
+    def _ensure_started(self):
+        if self._proc is None or self._proc.poll() is not None:
+            self._proc = subprocess.Popen(self._command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                          stderr=subprocess.DEVNULL, encoding="utf-8", bufsize=1)
+        return self._proc
+
+    def _feed(self, proc, sentences: List[str]):
+        try:
+            for sentence in sentences:
+                proc.stdin.write(sentence + "\n")
+            proc.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            pass  # the reader notices the dead process and reports it
+
+    def tag_batch(self, lines: Sequence[Sequence[str]]) -> List[TaggedLine]:
+        results: List[TaggedLine] = [[] for _ in lines]
+        # the JVM prints nothing for an empty sentence, so those never reach it
+        pending = [(i, list(tokens)) for i, tokens in enumerate(lines) if len(tokens) > 0]
+        if not pending:
+            return results
+        with self._lock:
+            proc = self._ensure_started()
+            # feed from a second thread so a large batch cannot deadlock on full pipe buffers
+            feeder = threading.Thread(target=self._feed, args=(proc, [' '.join(tokens) for _, tokens in pending]), daemon=True)
+            feeder.start()
+            try:
+                for i, tokens in pending:
+                    output = proc.stdout.readline()
+                    if not output:
+                        raise RuntimeError(f"Stanford tagger exited with code {proc.poll()}")
+                    tagged = [item.rsplit(self._SEPARATOR, 1) for item in output.split()]
+                    results[i] = [(word, pair[1] if len(pair) == 2 else '') for word, pair in zip(tokens, tagged)]
+            except Exception:
+                self._kill()
+                raise
+            finally:
+                feeder.join()
+        return results
+
+    def _kill(self):
+        if self._proc is not None:
+            self._proc.kill()
+            self._proc.wait()
+            self._proc = None
+
+    def close(self):
+        with self._lock:
+            if self._proc is not None:
+                self._proc.stdin.close()
+                try:
+                    self._proc.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    self._proc.kill()
+                self._proc = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_proc'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class RuleBasedPOSTagger(POSTagger):
+    """
+    Pure-Python tagger with the same interface as StanfordTaggerEngine.
+
+    A closed-class lexicon plus suffix rules, in the spirit of nltk's RegexpTagger. It is far
+    less accurate than the Stanford model but needs no JVM, which makes the keyword
+    replacement path usable in tests and on machines without Java.
+    """
+    _LEXICON = {
+        **dict.fromkeys(["a", "an", "the", "this", "that", "these", "those", "each", "every", "no", "some", "any", "all", "another"], "DT"),
+        **dict.fromkeys(["and", "or", "but", "nor", "yet", "so"], "CC"),
+        **dict.fromkeys(["in", "on", "at", "by", "for", "with", "from", "of", "about", "into", "over", "under", "after",
+                         "before", "between", "through", "during", "without", "within", "against", "among", "per", "via",
+                         "upon", "since", "until", "than", "as", "if", "because", "while", "although", "whether"], "IN"),
+        **dict.fromkeys(["i", "you", "he", "she", "it", "we", "they", "me", "him", "us", "them"], "PRP"),
+        **dict.fromkeys(["my", "your", "his", "her", "its", "our", "their"], "PRP$"),
+        **dict.fromkeys(["can", "could", "may", "might", "must", "shall", "should", "will", "would"], "MD"),
+        **dict.fromkeys(["is", "am", "are", "was", "were", "be", "been", "being", "has", "have", "had", "do", "does", "did"], "VB"),
+        **dict.fromkeys(["not", "very", "also", "too", "then", "there", "here", "now", "only", "just", "never", "always"], "RB"),
+        **dict.fromkeys(["who", "whom", "which", "what"], "WP"),
+        **dict.fromkeys(["when", "where", "why", "how"], "WRB"),
+        "to": "TO",
+    }
+    _RULES = [
+        (re.compile(r'^-?[0-9]+([.,:/-][0-9]+)*%?$'), 'CD'),
+        (re.compile(r'^[^\w\s]+$'), 'SYM'),
+        (re.compile(r'.*ing$'), 'VBG'),
+        (re.compile(r'.*ed$'), 'VBD'),
+        (re.compile(r'.*ly$'), 'RB'),
+        (re.compile(r'.*(able|ible|al|ful|ic|ive|less|ous|ary|ish)$'), 'JJ'),
+        (re.compile(r'.*(est)$'), 'JJS'),
+        (re.compile(r'.*(ness|ment|tion|sion|ity|ance|ence|ship|ism|ist|er|or)$'), 'NN'),
+        (re.compile(r'.*[^s]s$'), 'NNS'),
+    ]
+
+    def _tag_word(self, word: str, first: bool) -> str:
+        lowered = word.lower().strip('.,;:!?"\'()[]')
+        if lowered in self._LEXICON:
+            return self._LEXICON[lowered]
+        for pattern, tag in self._RULES:
+            if pattern.match(lowered):
+                return tag
+        if word[:1].isupper() and not first:
+            return 'NNP'
+        return 'NN'
+
+    def tag_batch(self, lines: Sequence[Sequence[str]]) -> List[TaggedLine]:
+        return [[(word, self._tag_word(word, i == 0)) for i, word in enumerate(tokens)] for tokens in lines]
+
+
+def build_pos_tagger(backend: str, pos_model_path: Optional[str] = None, pos_jar_path: Optional[str] = None) -> POSTagger:
+    if backend == 'stanford':
+        return StanfordTaggerEngine(pos_model_path, pos_jar_path)
+    if backend == 'rule':
+        return RuleBasedPOSTagger()
+    raise ValueError(f"Unknown POS backend {backend!r}. Choose from 'stanford' or 'rule'.")
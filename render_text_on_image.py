@@ -3,9 +3,20 @@ import numpy as np
 from PIL import ImageDraw, ImageFont, Image
 import multiprocessing
 from functools import partial
-import io
+import math
+import os
+import struct
 from copy import deepcopy
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import threading
+import warnings
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from augmentation_backends import per_line_rngs
+from content_cache import ContentCache
+from font_cache import FONT_CACHE, FontCache
+from instrumentation import METRICS, count, reset_metrics, timed
+from tiff_encoding import EncodeConfig, TiffAppender, copy_raw_page, encode_page, write_tiff
 from typing import List, Tuple, Dict, Optional, Any
 import time 
 import logging
@@ -13,50 +24,447 @@ from datetime import datetime
 #logging.basicConfig(filename=datetime.now().strftime('/fsx/dana_aubakirova/data-logs/page_level_data_aug_%H_%M_%d_%m_%Y.log'), level=logging.INFO,
 #                    format='%(asctime)s:%(levelname)s:%(message)s')
 
-def create_in_memory_tiff(images):# -> Optional[Image.Image]:
+class PatchedPage:
+    """
+    One version of a page kept as the original page, shared by all versions, plus the small patches
+    rendered for this version. The full-size raster only exists while the page is being encoded.
+    """
+    # modes whose numpy arrays convert back to the same mode, others are composited with Image.paste
+    _ARRAY_MODES = ('1', 'L', 'RGB', 'RGBA')
+
+    def __init__(self, base: Image.Image, patches: List[Tuple[Tuple[int, int], Image.Image]]):
+        self.base = base
+        self.patches = patches
+
+    def compose(self) -> Image.Image:
+        if not self.patches:
+            return self.base
+        if self.base.mode not in self._ARRAY_MODES:
+            page = self.base.copy()
+            for (left, top), patch in self.patches:
+                page.paste(patch, (left, top))
+            return page
+        pixels = np.array(self.base)
+        for (left, top), patch in self.patches:
+            pixels[top:top + patch.height, left:left + patch.width] = np.asarray(patch)
+        page = Image.fromarray(pixels, mode=self.base.mode) if self.base.mode != '1' else Image.fromarray(pixels)
+        page.info = self.base.info.copy()
+        return page
+
+def create_in_memory_tiff(images, encode_config: Optional[EncodeConfig] = None):# -> Optional[Image.Image]:
     if not images:
         return None  # Handle empty image list
-    buffer = io.BytesIO()
-    if len(images) == 1:
-        images[0].save(buffer, format='TIFF', compression='tiff_deflate')
-    else:
-        images[0].save(buffer, format='TIFF', save_all=True, append_images=images[1:], compression='tiff_deflate')
-    return buffer
+    # composed one frame at a time, so only one full page of a patched version is alive at a time
+    frames = (image.compose() if isinstance(image, PatchedPage) else image for image in images)
+    with timed("tiff_encode"):
+        return write_tiff(frames, encode_config or EncodeConfig())
 
-def modify_text_section(img, page: Dict[str, Any], selected_indexes: List[int], font_path: str, aug_func):
-    draw = ImageDraw.Draw(img)
+AUG_CHOICES = ["swap", "deletion", "insertion", "kreplacement"]
+# pages with fewer lines are left as they are
+MIN_LINES = 20
+
+def variant_rng(seed: int, key: str, variant: int, page: int = 0) -> random.Random:
+    """
+    The generator of one version of one page of the document `key`. It only depends on its arguments
+    (a str seed goes through sha512, not the salted str hash), so the output of a document is the same
+    whichever thread or process handles it, how many there are, and whether it is a rerun.
+    """
+    return random.Random(f"{seed}/{key}/{page}/{variant}")
+
+def pick_choices(page: Dict[str, Any], selected_indexes: List[int], rng=random) -> List[str]:
+    line_choices = []
     for selected_index in selected_indexes:
-        selected_bbox = page['bbox'][selected_index]
-        left, top, width_norm, height_norm = selected_bbox
-        width, height = img.size
-        x0, y0 = left * width, top * height
-        box_width, box_height = width_norm * width, height_norm * height
-        font = ImageFont.truetype(font_path, int(0.90 * box_height))
         old_text = page['text'][selected_index]
-        choices = ["swap", "deletion", "insertion", "kreplacement"]
-        choice = random.choice(choices)
+        choice = rng.choice(AUG_CHOICES)
         if choice == "kreplacement" and len(old_text)<=50:
-            choice = random.choice(choices[:-1])
-        new_text = aug_func.random_aug(old_text, 0.10, choice)  # Pass choice along with parameters
+            choice = rng.choice(AUG_CHOICES[:-1])
+        line_choices.append(choice)
+    return line_choices
+
+def tag_kreplacement_lines(page: Dict[str, Any], selected_indexes: List[List[int]], line_choices: List[List[str]], aug_func) -> Dict[str, Any]:
+    # one tagger round trip for every line of the page that goes through keyword replacement
+    return tag_lines([page['text'][index] for indexes, choices in zip(selected_indexes, line_choices)
+                      for index, choice in zip(indexes, choices) if choice == "kreplacement"], aug_func)
+
+def tag_lines(lines: List[str], aug_func) -> Dict[str, Any]:
+    lines = list(dict.fromkeys(lines))
+    if not lines or not aug_func.needs_tags:
+        return {}
+    count("lines_tagged", len(lines))
+    with timed("pos_tagging"):
+        return dict(zip(lines, aug_func.tag_batch(lines)))
+
+def augment_text_section(texts: List[str], line_choices: List[str], tagged_lines: Dict[str, Any], aug_func, rng=None) -> List[str]:
+    return aug_func.augment_batch(texts, 0.10, line_choices, rng or random, tagged_lines=tagged_lines)
+
+@dataclass
+class RenderConfig:
+    """
+    How new text is made and drawn. With fit_width the font size is also capped so the text fits the bbox
+    width (estimated from cached glyph advances); otherwise it is 0.90 of the bbox height.
+    mode "patch" renders only the modified lines as small patches over one shared copy of each page
+    (see PatchedPage); mode "full" draws every version on its own full copy of the page.
+    line_cache keeps the augmented text of lines by (backend, seed, version, op, line), see process_page.
+    patch_cache keeps the rendered text of lines by (font, size, text), see text_mask; with it text is
+    drawn from the bbox corner rounded down to whole pixels instead of from its exact fractional position.
+    """
+    fit_width: bool = False
+    font_cache: FontCache = FONT_CACHE
+    mode: str = "patch"
+    line_cache: Optional[ContentCache] = None
+    patch_cache: Optional[ContentCache] = None
+
+def line_layout(img_size: Tuple[int, int], page: Dict[str, Any], selected_index: int, new_text: str, font_path: str,
+                render_config: RenderConfig):
+    selected_bbox = page['bbox'][selected_index]
+    left, top, width_norm, height_norm = selected_bbox
+    width, height = img_size
+    x0, y0 = left * width, top * height
+    box_width, box_height = width_norm * width, height_norm * height
+    if render_config.fit_width:
+        font_size = render_config.font_cache.fitted_size(font_path, new_text, box_width, box_height)
+    else:
+        font_size = int(0.90 * box_height)
+    font = render_config.font_cache.get(font_path, font_size)
+    return x0, y0, box_width, box_height, font
+
+def patch_cache_size(value: Tuple[Image.Image, Tuple[int, int]]) -> int:
+    return value[0].width * value[0].height
+
+def encode_text_mask(value: Tuple[Image.Image, Tuple[int, int]]) -> bytes:
+    mask, (left, top) = value
+    return struct.pack('<4i1s', left, top, mask.width, mask.height, mask.mode.encode()) + mask.tobytes()
+
+def decode_text_mask(data: bytes) -> Tuple[Image.Image, Tuple[int, int]]:
+    left, top, width, height, mode = struct.unpack_from('<4i1s', data)
+    return Image.frombytes(mode.decode(), (width, height), data[struct.calcsize('<4i1s'):]), (left, top)
+
+def text_mask(text: str, font: ImageFont.FreeTypeFont, fontmode: str, cache: ContentCache) -> Tuple[Image.Image, Tuple[int, int]]:
+    """
+    The coverage of `text` drawn from a whole-pixel origin, and its offset from that origin, kept in `cache`
+    by (font file, size, font mode, text). fontmode is the ImageDraw.fontmode of the target image ("1" for
+    bilevel pages, "L" for antialiased text). Drawing ink through the mask at origin + offset gives the same
+    pixels as ImageDraw.text at the origin.
+    """
+    key = (font.path, font.size, fontmode, text)
+    value = cache.get(key)
+    if value is None:
+        with timed("text_mask"):
+            left, top, right, bottom = ImageDraw.Draw(Image.new(fontmode, (1, 1))).textbbox((0, 0), text, font=font)
+            mask = Image.new(fontmode, (max(right - left, 0), max(bottom - top, 0)))
+            ImageDraw.Draw(mask).text((-left, -top), text, fill=255, font=font)
+        value = (mask, (left, top))
+        cache.put(key, value)
+    return value
+
+def _paste_text(img: Image.Image, origin: Tuple[int, int], mask: Image.Image, offset: Tuple[int, int]):
+    if mask.width and mask.height:
+        ImageDraw.Draw(img).bitmap((origin[0] + offset[0], origin[1] + offset[1]), mask, fill="black")
+
+def build_caches(line_cache_size: int = 0, patch_cache_mb: float = 0, cache_dir: Optional[str] = None,
+                 disk_entries: int = 1_000_000) -> Tuple[Optional[ContentCache], Optional[ContentCache]]:
+    """RenderConfig's line_cache and patch_cache (None for size 0), with their on-disk stores in cache_dir if given."""
+    line_cache = patch_cache = None
+    if line_cache_size:
+        line_cache = ContentCache("line_cache", max_entries=line_cache_size, disk_entries=disk_entries,
+                                  disk_path=os.path.join(cache_dir, "lines.sqlite") if cache_dir else None,
+                                  encode=str.encode, decode=bytes.decode)
+    if patch_cache_mb:
+        patch_cache = ContentCache("patch_cache", max_bytes=int(patch_cache_mb * 2 ** 20), disk_entries=disk_entries,
+                                   disk_path=os.path.join(cache_dir, "patches.sqlite") if cache_dir else None,
+                                   sizeof=patch_cache_size, encode=encode_text_mask, decode=decode_text_mask)
+    return line_cache, patch_cache
+
+@timed("render")
+def render_text_section(img, page: Dict[str, Any], selected_indexes: List[int], new_texts: List[str], font_path: str,
+                        render_config: Optional[RenderConfig] = None):
+    render_config = render_config or RenderConfig()
+    draw = ImageDraw.Draw(img)
+    for selected_index, new_text in zip(selected_indexes, new_texts):
+        x0, y0, box_width, box_height, font = line_layout(img.size, page, selected_index, new_text, font_path, render_config)
         page['text'][selected_index] = new_text
         draw.rectangle([x0, y0, x0 + box_width, y0 + box_height], fill="white")
-        draw.text((x0, y0), new_text, fill="black", font=font)
+        if render_config.patch_cache is not None:
+            mask, offset = text_mask(new_text, font, draw.fontmode, render_config.patch_cache)
+            _paste_text(img, (int(x0), int(y0)), mask, offset)
+        else:
+            draw.text((x0, y0), new_text, fill="black", font=font)
     return img, page
-def process_page(image: Image.Image, page, font_path: str,  aug_func):
-    
-    if len(page['text']) < 20:
-        return zip(*[(image.copy(), page) for _ in range(3)])  # Skip pages with too little text
+
+@timed("render")
+def render_text_patches(base: Image.Image, page: Dict[str, Any], selected_indexes: List[int], new_texts: List[str], font_path: str,
+                        render_config: RenderConfig):
+    """
+    Patch version of render_text_section. Each patch covers the white box and the text extent of one
+    line and is drawn on a crop at an integer offset, so the fractional text position and therefore
+    the pixels are the same as when drawing on the full page. Earlier patches are pasted into later
+    crops, which keeps overlapping lines identical to sequential drawing.
+    """
+    width, height = base.size
+    fontmode = ImageDraw.Draw(base).fontmode
+    patches = []
+    for selected_index, new_text in zip(selected_indexes, new_texts):
+        x0, y0, box_width, box_height, font = line_layout(base.size, page, selected_index, new_text, font_path, render_config)
+        page['text'][selected_index] = new_text
+        if render_config.patch_cache is not None:
+            mask, offset = text_mask(new_text, font, fontmode, render_config.patch_cache)
+            origin = (int(x0), int(y0))
+            text_box = (origin[0] + offset[0], origin[1] + offset[1], origin[0] + offset[0] + mask.width, origin[1] + offset[1] + mask.height)
+        else:
+            text_box = ImageDraw.Draw(base).textbbox((x0, y0), new_text, font=font)
+        left = max(0, math.floor(min(x0, text_box[0])) - 1)
+        top = max(0, math.floor(min(y0, text_box[1])) - 1)
+        right = min(width, math.ceil(max(x0 + box_width, text_box[2])) + 2)
+        bottom = min(height, math.ceil(max(y0 + box_height, text_box[3])) + 2)
+        if right <= left or bottom <= top:
+            continue
+        patch = base.crop((left, top, right, bottom))
+        for (patch_left, patch_top), earlier in patches:
+            if patch_left < right and patch_left + earlier.width > left and patch_top < bottom and patch_top + earlier.height > top:
+                patch.paste(earlier, (patch_left - left, patch_top - top))
+        draw = ImageDraw.Draw(patch)
+        draw.rectangle([x0 - left, y0 - top, x0 - left + box_width, y0 - top + box_height], fill="white")
+        if render_config.patch_cache is not None:
+            _paste_text(patch, (origin[0] - left, origin[1] - top), mask, offset)
+        else:
+            draw.text((x0 - left, y0 - top), new_text, fill="black", font=font)
+        patches.append(((left, top), patch))
+    return PatchedPage(base, patches), page
+
+def modify_text_section(img, page: Dict[str, Any], selected_indexes: List[int], font_path: str, aug_func,
+                        line_choices: Optional[List[str]] = None, tagged_lines: Optional[Dict[str, Any]] = None,
+                        render_config: Optional[RenderConfig] = None, rng=random):
+    if line_choices is None:
+        line_choices = pick_choices(page, selected_indexes, rng)
+    if tagged_lines is None:
+        tagged_lines = tag_kreplacement_lines(page, [selected_indexes], [line_choices], aug_func)
+    new_texts = augment_text_section([page['text'][i] for i in selected_indexes], line_choices, tagged_lines, aug_func, rng)  # Pass choice along with parameters
+    return render_text_section(img, page, selected_indexes, new_texts, font_path, render_config)
+
+@dataclass
+class ParallelConfig:
+    """
+    How the work on one shard is nested with augment_idl_shards_util --extract_to_temp:
+    - file_threads documents of the shard are processed at once (threads, augment_idl_shards_util),
+    - page_threads pages of each document are processed at once (threads, mask_and_replace_text),
+    - every page yields n_variants versions; the text augmentation of each version is one task for a shared
+      pool of aug_processes worker processes, created once per shard (0 runs it in the page thread).
+    When streaming, each worker process takes one document at a time and augments in its page threads, so only
+    page_threads and memory_budget apply.
+    Tagging and rendering stay in the page threads, so no image ever crosses a process boundary.
+    memory_budget caps the bytes of decoded and rendered pages each worker process holds at once (see MemoryBudget).
+    """
+    file_threads: int = 12
+    page_threads: int = 3
+    aug_processes: int = 3
+    memory_budget: Optional[int] = None
+
+class MemoryBudget:
+    """
+    Bytes of decoded and rendered pages a process may hold at once, shared by all documents and page threads
+    of the process. A page that does not fit waits for others to finish; one page is always let through, so a
+    page larger than the whole budget still runs, alone. No limit without `limit`.
+    """
+    def __init__(self, limit: Optional[int] = None):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, n: int):
+        with self._condition:
+            if self.limit is not None and self.used > 0 and self.used + n > self.limit:
+                start = time.perf_counter()
+                while self.used > 0 and self.used + n > self.limit:
+                    self._condition.wait()
+                METRICS.add_time("memory_wait", time.perf_counter() - start)
+            self.used += n
+            self.peak = max(self.peak, self.used)
+
+    def release(self, n: int):
+        with self._condition:
+            self.used -= n
+            self._condition.notify_all()
+
+PAGE_MEMORY = MemoryBudget()
+
+def set_memory_budget(limit: Optional[int]):
+    """Process pool initializer: the budget shared by every document this process works on."""
+    global PAGE_MEMORY
+    PAGE_MEMORY = MemoryBudget(limit)
+
+def check_page_pixels(size: Tuple[int, int]):
+    """Pillow's decompression bomb check on a page's header size, before the page is decoded."""
+    if Image.MAX_IMAGE_PIXELS is None:
+        return
+    pixels = size[0] * size[1]
+    if pixels > 2 * Image.MAX_IMAGE_PIXELS:
+        raise Image.DecompressionBombError(f"Image size ({pixels} pixels) exceeds limit of {2 * Image.MAX_IMAGE_PIXELS} pixels, "
+                                           "could be decompression bomb DOS attack.")
+    if pixels > Image.MAX_IMAGE_PIXELS:
+        warnings.warn(f"Image size ({pixels} pixels) exceeds limit of {Image.MAX_IMAGE_PIXELS} pixels, "
+                      "could be decompression bomb DOS attack.", Image.DecompressionBombWarning)
+
+def page_footprint(size: Tuple[int, int], mode: str, n_variants: int, render_mode: str) -> int:
+    """Estimated peak bytes of one page in flight: the decoded page and either the full-size versions, or one composed version and its array."""
+    raster = size[0] * size[1] * (1 if mode in ('1', 'L', 'P') else 4)
+    return raster * (n_variants + 1 if render_mode == "full" else 3)
+
+_worker_aug_func = None
+
+def _init_aug_worker(aug_func):
+    global _worker_aug_func
+    _worker_aug_func = aug_func
+    reset_metrics()
+
+def _augment_in_worker(texts: List[str], line_choices: List[str], tagged_lines: Dict[str, Any], rng: Optional[random.Random]):
+    # the worker's timings travel back with every result
+    return augment_text_section(texts, line_choices, tagged_lines, _worker_aug_func, rng), METRICS.drain()
+
+def _unpack_worker_result(future: Future, result: Future):
+    try:
+        new_texts, metrics = future.result()
+    except Exception as e:
+        result.set_exception(e)
+        return
+    METRICS.merge(metrics)
+    result.set_result(new_texts)
+
+class AugmentationPool:
+    """
+    Long-lived process pool holding one copy of the augmenter per worker, shared by all pages of a shard.
+    A task's rng is pickled along with it and is its last user, so its results don't depend on where it runs.
+    Augmenters that batch (aug_func.batches) always run in the calling process, where their batcher sees the
+    lines of every thread; a worker process would only ever see the lines of one task.
+    """
+    def __init__(self, aug_func, n_processes: int):
+        self.aug_func = aug_func
+        self._executor = None
+        if n_processes > 0 and not getattr(aug_func, 'batches', False):
+            self._executor = ProcessPoolExecutor(max_workers=n_processes, initializer=_init_aug_worker, initargs=(aug_func,))
+            # start the workers now, before the file and page threads exist, instead of forking from inside one of them
+            self._executor.submit(int).result()
+
+    def submit(self, texts: List[str], line_choices: List[str], tagged_lines: Dict[str, Any], rng: Optional[random.Random] = None) -> Future:
+        future = Future()
+        if self._executor is not None:
+            self._executor.submit(_augment_in_worker, texts, line_choices, tagged_lines, rng).add_done_callback(partial(_unpack_worker_result, result=future))
+            return future
+        try:
+            future.set_result(augment_text_section(texts, line_choices, tagged_lines, self.aug_func, rng))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def submit_versions(self, texts: List[List[str]], line_choices: List[List[str]], tagged_lines: Dict[str, Any],
+                        rngs: List[Any]) -> List[Future]:
+        """
+        submit for each version of a page. Without worker processes all versions go to the augmenter in one
+        augment_batch call, each line drawing from the rng of its version, so the results are the same.
+        """
+        if self._executor is not None:
+            return [self.submit(version_texts, choices, tagged_lines, rng) for version_texts, choices, rng in zip(texts, line_choices, rngs)]
+        futures = [Future() for _ in texts]
+        try:
+            new_texts = augment_text_section([text for version_texts in texts for text in version_texts],
+                                             [choice for choices in line_choices for choice in choices], tagged_lines, self.aug_func,
+                                             [line_rng for version_texts, rng in zip(texts, rngs)
+                                              for line_rng in per_line_rngs(rng or random, len(version_texts))])
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return futures
+        start = 0
+        for future, version_texts in zip(futures, texts):
+            future.set_result(new_texts[start:start + len(version_texts)])
+            start += len(version_texts)
+        return futures
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _fill_from_cache(future: Future, result: Future, cached: List[Optional[str]], keys: List[Tuple], missing: List[Tuple],
+                     line_cache: ContentCache):
+    try:
+        new_texts = dict(zip(missing, future.result()))
+    except Exception as e:
+        result.set_exception(e)
+        return
+    for key, text in new_texts.items():
+        line_cache.put(key, text)
+    result.set_result([text if text is not None else new_texts[key] for text, key in zip(cached, keys)])
+
+def submit_cached(pages_texts: List[List[str]], split_choices: List[List[str]], aug_func, pool: AugmentationPool, salts: List[str],
+                  line_cache: ContentCache) -> List[Future]:
+    """
+    Like pool.submit_versions, but lines already in line_cache are not augmented (nor tagged) again. A line
+    is keyed by (aug_func.cache_tag, salt of its version, op, text) and augmented with its own Random(key), so its
+    new text is a function of the key alone and the same whether it was cached or not.
+    """
+    keys = [[(aug_func.cache_tag, salt, choice, text) for text, choice in zip(texts, choices)]
+            for texts, choices, salt in zip(pages_texts, split_choices, salts)]
+    cached = [[line_cache.get(key) for key in variant_keys] for variant_keys in keys]
+    # repeated lines of a version are augmented once
+    missing = [list(dict.fromkeys(key for key, text in zip(variant_keys, texts) if text is None))
+               for variant_keys, texts in zip(keys, cached)]
+    tagged_lines = tag_lines([key[3] for variant_missing in missing for key in variant_missing if key[2] == "kreplacement"], aug_func)
+    pending = [variant_missing for variant_missing in missing if variant_missing]
+    submitted = iter(pool.submit_versions([[key[3] for key in variant_missing] for variant_missing in pending],
+                                          [[key[2] for key in variant_missing] for variant_missing in pending], tagged_lines,
+                                          [[random.Random(repr(key)) for key in variant_missing] for variant_missing in pending]))
+    futures = []
+    for variant_keys, variant_cached, variant_missing in zip(keys, cached, missing):
+        result = Future()
+        if variant_missing:
+            next(submitted).add_done_callback(partial(_fill_from_cache, result=result, cached=variant_cached, keys=variant_keys,
+                                                      missing=variant_missing, line_cache=line_cache))
+        else:
+            result.set_result(variant_cached)
+        futures.append(result)
+    return futures
+
+def process_page(image: Image.Image, page, font_path: str,  aug_func, pool: Optional[AugmentationPool] = None,
+                 render_config: Optional[RenderConfig] = None, n_variants: int = 3, rngs: Optional[List[random.Random]] = None,
+                 salts: Optional[List[str]] = None):
+    # rngs: one generator per version (see variant_rng), the global random module if not given
+    # salts: one str per version for the keys of render_config.line_cache, which is only used with them
+    render_config = render_config or RenderConfig()
+    if len(page['text']) < MIN_LINES:
+        count("pages_skipped")
+        if render_config.mode == "patch":
+            return [PatchedPage(image, []) for _ in range(n_variants)], [page for _ in range(n_variants)]
+        return zip(*[(image.copy(), page) for _ in range(n_variants)])  # Skip pages with too little text
     lines = len(page['text'])
     selected_lines = int(max(1, 0.4 * lines))
-    splits = [random.sample(range(lines), min(selected_lines, lines)) for i in range(3)]
-    # Update to pass aug_func and stopwords to modify_text_section
-    partial_modify_text_section = partial(modify_text_section, font_path=font_path, aug_func=aug_func)
-    image_copies = [image, image.copy(), image.copy()] #TODO more flexible
-    page_copies = [page, deepcopy(page), deepcopy(page)]
-    with ProcessPoolExecutor(max_workers=3) as executor:
-        futures = [executor.submit(partial_modify_text_section, img, page, split) for img, page, split in zip(image_copies, page_copies, splits)]
-
-    results = [future.result() for future in futures]
+    variant_rngs = rngs or [None] * n_variants
+    splits = [(rng or random).sample(range(lines), min(selected_lines, lines)) for rng in variant_rngs]
+    split_choices = [pick_choices(page, split, rng or random) for split, rng in zip(splits, variant_rngs)]
+    count("lines_augmented", sum(len(split) for split in splits))
+    if pool is None:
+        pool = AugmentationPool(aug_func, 0)
+    if render_config.line_cache is not None and salts is not None:
+        futures = submit_cached([[page['text'][i] for i in split] for split in splits], split_choices, aug_func, pool, salts,
+                                render_config.line_cache)
+    else:
+        # tag once per page for all versions instead of once per line inside every worker
+        tagged_lines = tag_kreplacement_lines(page, splits, split_choices, aug_func)
+        futures = pool.submit_versions([[page['text'][i] for i in split] for split in splits], split_choices, tagged_lines, variant_rngs)
+    page_copies = [page] + [deepcopy(page) for _ in range(n_variants - 1)]
+    if render_config.mode == "patch":
+        results = [render_text_patches(image, page, split, future.result(), font_path, render_config)
+                   for page, split, future in zip(page_copies, splits, futures)]
+    else:
+        image_copies = [image] + [image.copy() for _ in range(n_variants - 1)]
+        results = [render_text_section(img, page, split, future.result(), font_path, render_config)
+                   for img, page, split, future in zip(image_copies, page_copies, splits, futures)]
     if results:
         images, pages = zip(*results)
         return images, pages
@@ -82,38 +490,102 @@ def mask_and_replace_text(sample, metadata, font_path, aug_func):
     annotation = [{'pages': ann} for ann in versioned_anns]
     return multi_page_tiffs, annotation
 '''
-def process_page_wrapper(args):
-    image_array, page_annotation, font_path, aug_func = args
-    return process_page(image_array, page_annotation, font_path, aug_func)
+def decode_page(sample, index: int) -> Image.Image:
+    with timed("page_decode"):
+        sample.seek(index)
+        if sample.mode not in ('P', 'PA'):
+            # seeking past a palette frame that was never loaded (skipped or copied raw) keeps its palette
+            sample.palette = None
+        return sample.copy()
 
-def mask_and_replace_text(sample, metadata, font_path, aug_func):
-    annotation = metadata['pages']
-    num_threads = min(3, max(len(annotation), 1))  # Define number of threads
-    
-    images = []
-    # this avoids passing the whole sample to each thread
-    # but it creates a BIG memory overhead potentially, let's see
+def _encode_frame(frame, encode_config: EncodeConfig) -> bytes:
+    with timed("tiff_encode"):
+        return encode_page(frame.compose() if isinstance(frame, PatchedPage) else frame, encode_config)
 
-    for i in range(len(annotation)):
-        sample.seek(i)
-        # this should change the .seek()... to a list of images containing a copy of current sample
-        images.append(sample.copy())
+def _augment_and_encode_page(image: Image.Image, page, font_path: str, aug_func, pool: Optional[AugmentationPool], render_config: RenderConfig,
+                             encode_config: EncodeConfig, n_variants: int, rngs, salts, encoder: ThreadPoolExecutor, memory_budget: MemoryBudget,
+                             footprint: int):
+    """
+    All versions of one page, encoded: (list of single-page TIFF streams, list of page annotations). The streams
+    are None when every version is the unchanged page, which the caller then copies from the source once.
+    """
+    try:
+        images, pages = tuple(process_page(image, page, font_path, aug_func, pool, render_config, n_variants, rngs, salts) or ((), ()))
+        if encode_config.reuse_unchanged and all(isinstance(img, PatchedPage) and not img.patches for img in images):
+            return None, pages
+        return list(encoder.map(partial(_encode_frame, encode_config=encode_config), images)), pages
+    finally:
+        memory_budget.release(footprint)
 
-    # then we can build args to pass in parallel
-    args = [(images[i], annotation[i], font_path, aug_func) for i in range(len(annotation))]
-    # the executor.map will do the rest and return the results in order
+def mask_and_replace_text(sample, metadata, font_path, aug_func, pool: Optional[AugmentationPool] = None, page_threads: int = 3,
+                          render_config: Optional[RenderConfig] = None, encode_config: Optional[EncodeConfig] = None,
+                          n_variants: int = 3, seed: Optional[int] = None, key: str = "", memory_budget: Optional[MemoryBudget] = None):
+    """
+    With a seed, every version of every page draws from its own variant_rng(seed, key, version, page), so the
+    output only depends on (seed, key) and the document. Without one the global random module is used, and
+    render_config.line_cache is not.
 
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-        results = list(executor.map(process_page_wrapper, args))
-    
-    versioned_images = [[], [], []]
-    versioned_anns = [[], [], []]
-    for modified_imgs, pages in results:
-        for idx, (img, pg) in enumerate(zip(modified_imgs, pages)):
-            versioned_images[idx].append(img)
-            versioned_anns[idx].append(pg)
+    Pages are streamed: each is decoded only when it enters a window of 2 * page_threads pages in flight, which
+    also waits for room in the memory budget (the process-wide PAGE_MEMORY by default), and its encoded versions
+    are appended to the output TIFFs in page order as soon as it is done. Pages with fewer than MIN_LINES lines
+    are not decoded at all; their original strips are copied to every version. A document that yields no page
+    raises ValueError rather than returning empty TIFFs.
+    """
+    render_config = render_config or RenderConfig()
+    encode_config = encode_config or EncodeConfig()
+    memory_budget = memory_budget or PAGE_MEMORY
+    annotation = metadata['pages']
+    outputs = [TiffAppender() for _ in range(n_variants)]
+    versioned_anns = [[] for _ in range(n_variants)]
+    window = 2 * max(page_threads, 1)
+    in_flight = deque()
+    # cached lines are shared by every document and page of a version, so their keys leave out the key and page
+    salts = [f"{seed}/{variant}" for variant in range(n_variants)] if seed is not None else None
 
-    multi_page_tiffs = [create_in_memory_tiff(img_list) for img_list in versioned_images]
-    annotations = [{'pages': ann} for ann in versioned_anns]
-    
-    return multi_page_tiffs, annotations
+    def append_next():
+        index, future = in_flight.popleft()
+        frames, pages = future.result()
+        if frames is None:
+            data = copy_raw_page(sample, index)
+            if data is None:
+                data = _encode_frame(decode_page(sample, index), encode_config)
+            frames = [data] * n_variants
+        for output, anns, frame, page in zip(outputs, versioned_anns, frames, pages):
+            output.append(frame)
+            anns.append(page)
+
+    with ThreadPoolExecutor(max_workers=max(1, page_threads)) as executor, \
+            ThreadPoolExecutor(max_workers=max(1, encode_config.workers)) as encoder:
+        for i, page in enumerate(annotation):
+            while in_flight and (len(in_flight) >= window or in_flight[0][1].done()):
+                append_next()
+            if len(page['text']) < MIN_LINES and encode_config.reuse_unchanged:
+                # the page is the same in every version: no decoding, no rendering, no re-encoding
+                count("pages_skipped")
+                future = Future()
+                future.set_result((None, [page] * n_variants))
+                in_flight.append((i, future))
+                continue
+            sample.seek(i)
+            check_page_pixels(sample.size)
+            footprint = page_footprint(sample.size, sample.mode, n_variants, render_config.mode)
+            memory_budget.acquire(footprint)
+            try:
+                image = decode_page(sample, i)
+            except BaseException:
+                memory_budget.release(footprint)
+                raise
+            rngs = [variant_rng(seed, key, variant, i) for variant in range(n_variants)] if seed is not None else None
+            in_flight.append((i, executor.submit(_augment_and_encode_page, image, page, font_path, aug_func, pool, render_config,
+                                                 encode_config, n_variants, rngs, salts, encoder, memory_budget, footprint)))
+            del image
+        while in_flight:
+            append_next()
+
+    if not all(output.n_pages for output in outputs):
+        raise ValueError(f"The document has no pages to write ({len(annotation)} annotated).")
+    annotations = [{'pages': anns} for anns in versioned_anns]
+    count("documents")
+    count("pages", len(annotation))
+    count("variants", n_variants)
+    return [output.buffer for output in outputs], annotations
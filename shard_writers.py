@@ -0,0 +1,238 @@
+import glob
+import logging
+import os
+import queue
+import re
+import tarfile
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Set
+
+from webdataset import ShardWriter, TarWriter
+
+from instrumentation import count, timed
+
+_logger = logging.getLogger('endless_attempts')
+_STOP = object()
+MANIFEST_SUFFIX = ".manifest"
+# webdataset's sample key: the member path up to the first dot of the file name, the rest is the extension
+SAMPLE_KEY_RE = re.compile(r"^((?:.*/|)[^.]+)[.]([^/]*)$")
+
+
+@dataclass
+class WriterConfig:
+    """
+    How the output of one input shard is written.
+    - maxcount / maxsize: roll over to a new numbered output shard <shard>_<variant>-000000.tar,
+      -000001.tar, ... after this many samples / bytes, like webdataset's ShardWriter. Without
+      either, every variant goes to a single <shard>_<variant>.tar.
+    - queue_size: samples waiting per writer thread; producers block once it is full.
+    """
+    maxcount: Optional[int] = None
+    maxsize: Optional[float] = None
+    queue_size: int = 16
+
+    @property
+    def rolls_over(self) -> bool:
+        return self.maxcount is not None or self.maxsize is not None
+
+
+def output_parts(final_dir: str, base_name: str, variant: int) -> List[str]:
+    """Every output tar of one variant: <base>_<variant>.tar and the numbered parts <base>_<variant>-NNNNNN.tar."""
+    prefix = os.path.join(final_dir, f"{base_name}_{variant}")
+    single = [prefix + ".tar"] if os.path.exists(prefix + ".tar") else []
+    return single + sorted(glob.glob(glob.escape(prefix) + "-" + "[0-9]" * 6 + ".tar"))
+
+
+def _part_number(path: str) -> int:
+    match = re.search(r"-([0-9]{6})\.tar$", path)
+    return int(match.group(1)) if match else -1
+
+
+def read_manifest(tar_path: str) -> List[str]:
+    """Keys recorded as completely written to `tar_path`, empty if it has no manifest."""
+    try:
+        with open(tar_path + MANIFEST_SUFFIX, 'r') as manifest:
+            return [line.rstrip('\n') for line in manifest if line.endswith('\n')]
+    except FileNotFoundError:
+        return []
+
+
+def count_output_samples(tar_path: str, counts: Dict[str, int]):
+    """Adds one to counts[key] for every sample of the tar with both a tif and a json member read in full."""
+    extensions: Dict[str, set] = {}
+    try:
+        with tarfile.open(tar_path, "r|*") as tar:
+            for member in tar:
+                match = SAMPLE_KEY_RE.match(member.name)
+                if member.isfile() and match is not None:
+                    tar.extractfile(member).read()
+                    extensions.setdefault(match.group(1), set()).add(match.group(2).lower())
+    except (tarfile.TarError, EOFError, OSError) as e:
+        # a part cut off by an interrupted run, the samples before the cut still count
+        _logger.warning(f"{tar_path} ends early: {e}")
+    for key, found in extensions.items():
+        if {'tif', 'json'} <= found:
+            counts[key] = counts.get(key, 0) + 1
+
+
+def recover_manifest(tar_path: str) -> List[str]:
+    """
+    Keys of the complete samples of `tar_path` that its manifest does not list, because the run was killed after
+    the sample was flushed and before its key was recorded. They are appended to the manifest, so later resumes,
+    which only look at their own last part, see them too.
+    """
+    counts: Dict[str, int] = {}
+    count_output_samples(tar_path, counts)
+    listed = set(read_manifest(tar_path))
+    missing = [key for key in counts if key not in listed]
+    if missing:
+        _logger.warning(f"{len(missing)} complete samples of {tar_path} are missing from its manifest, adding them.")
+        with open(tar_path + MANIFEST_SUFFIX, 'a') as manifest:
+            manifest.writelines(key + '\n' for key in missing)
+    return missing
+
+
+def _flush_tar(tar_writer: TarWriter):
+    # TarWriter streams through tarfile's "w|" mode, which holds back up to one record in its own
+    # buffer; writing it out early leaves the file byte for byte the same once it is closed
+    stream = tar_writer.tarstream.fileobj
+    if getattr(stream, 'comptype', None) == 'tar' and stream.buf:
+        stream.fileobj.write(stream.buf)
+        stream.buf = b""
+    tar_writer.stream.flush()
+
+
+class VariantWriter:
+    """
+    One output stream, written by its own thread from a bounded queue, so producers never wait on
+    each other for the tar file. Keys already written to the current output shard are skipped;
+    the set of seen keys is dropped on every rollover, so it never outgrows one shard.
+
+    Next to every tar a manifest lists the keys written to it, one per line, appended only after
+    the sample has been flushed to the tar. Keys in `completed` (read from the manifests of an
+    earlier, interrupted run) are skipped too. Existing files are never reopened: a resumed run
+    writes to the next numbered part, starting at `first_part`, and files are only created once
+    the first sample arrives.
+    """
+
+    def __init__(self, prefix: str, config: WriterConfig, completed: Optional[Set[str]] = None, first_part: Optional[int] = None):
+        self.prefix = prefix
+        self.config = config
+        self.completed = completed or set()
+        self.first_part = first_part
+        self._writer = None
+        self._manifest = None
+        self._current_file = None
+        self._keys = set()
+        self.written = 0
+        self.skipped = 0
+        self._queue = queue.Queue(maxsize=max(1, config.queue_size))
+        self._thread = threading.Thread(target=self._run, name=f"writer-{prefix}", daemon=True)
+        self._thread.start()
+
+    def _open(self):
+        if self.config.rolls_over:
+            self._writer = ShardWriter(self.prefix + "-%06d.tar", maxcount=self.config.maxcount or float('inf'),
+                                       maxsize=self.config.maxsize or float('inf'), start_shard=self.first_part or 0,
+                                       verbose=0, post=lambda fname: _logger.info(f"Finished output shard {fname}."))
+        elif self.first_part is None:
+            self._writer = TarWriter(self.prefix + ".tar")
+        else:
+            self._writer = TarWriter(self.prefix + f"-{self.first_part:06d}.tar")
+
+    def _tar_writer(self) -> TarWriter:
+        return self._writer.tarstream if isinstance(self._writer, ShardWriter) else self._writer
+
+    def _file_name(self) -> str:
+        return getattr(self._writer, 'fname', None) or self._tar_writer().stream.name
+
+    def write(self, sample: Dict[str, Any]):
+        self._queue.put(sample)
+
+    def _run(self):
+        while True:
+            sample = self._queue.get()
+            if sample is _STOP:
+                return
+            try:
+                self._write(sample)
+            except Exception as e:
+                _logger.error(f"Error writing {sample.get('__key__')} to {self._current_file}: {e}", exc_info=True)
+
+    def _write(self, sample: Dict[str, Any]):
+        key = sample["__key__"]
+        if key in self._keys or key in self.completed:
+            self.skipped += 1
+            count("samples_skipped")
+            _logger.info(f"Skipping writing {key} as it's already written.")
+            return
+        with timed("tar_write"):
+            if self._writer is None:
+                self._open()
+            self._writer.write(sample)
+            if self._file_name() != self._current_file:
+                self._current_file, self._keys = self._file_name(), set()
+                if self._manifest is not None:
+                    self._manifest.close()
+                self._manifest = open(self._current_file + MANIFEST_SUFFIX, 'a')
+            # the key is only recorded once the sample itself has left the process
+            _flush_tar(self._tar_writer())
+            self._manifest.write(key + '\n')
+            self._manifest.flush()
+        count("samples_written")
+        self._keys.add(key)
+        self.written += 1
+        _logger.info(f"Wrote {key} to {self._current_file}.")
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        if self._writer is not None:
+            self._writer.close()
+        if self._manifest is not None:
+            self._manifest.close()
+
+
+class VariantWriters:
+    """
+    The writers of all variants of one input shard, variant i goes to <final_dir>/<base_name>_<i>.
+    Outputs of an earlier run of the same shard are picked up from their manifests, see VariantWriter, and from
+    the samples of the last part that its manifest misses, see recover_manifest.
+    """
+
+    def __init__(self, final_dir: str, base_name: str, n_variants: int, config: Optional[WriterConfig] = None):
+        config = config or WriterConfig()
+        os.makedirs(final_dir, exist_ok=True)
+        self.writers: List[VariantWriter] = []
+        for i in range(n_variants):
+            parts = output_parts(final_dir, base_name, i)
+            completed = {key for part in parts for key in read_manifest(part)}
+            if parts:
+                # only the last part can have been cut off between a sample and its manifest line
+                completed.update(recover_manifest(parts[-1]))
+            first_part = max(_part_number(part) for part in parts) + 1 if parts else None
+            if parts:
+                _logger.info(f"Resuming variant {i} of {base_name}: {len(completed)} samples done in {len(parts)} files.")
+            self.writers.append(VariantWriter(os.path.join(final_dir, f"{base_name}_{i}"), config, completed, first_part))
+
+    def __len__(self):
+        return len(self.writers)
+
+    def is_done(self, base_key: str) -> bool:
+        """Whether every variant of the input sample `base_key` was written by an earlier run."""
+        return all(f"{base_key}_{i}" in writer.completed for i, writer in enumerate(self.writers))
+
+    def write(self, variant: int, sample: Dict[str, Any]):
+        self.writers[variant].write(sample)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
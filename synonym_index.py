@@ -0,0 +1,193 @@
+import argparse
+import json
+import mmap
+import struct
+import threading
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from instrumentation import count, timed
+
+# pos letters wordnet.synsets accepts, any other letter makes it raise and fall back to all synsets
+WORDNET_POS = ('n', 'v', 'a', 'r', 's')
+_ALL = '*'
+_SYNONYMS = 'syn'
+_MAGIC = b'SYNIDX1\n'
+_HEADER = struct.Struct('<8sQ')
+# nltk's WordNet reader seeks and reads shared file handles, so live lookups from several threads must not overlap
+_WORDNET_LOCK = threading.Lock()
+
+
+def _wordnet():
+    from nltk.corpus import wordnet
+    return wordnet
+
+
+def _lemma_names(word: str) -> List[str]:
+    synonyms = set()
+    for syn in _wordnet().synsets(word):
+        for l in syn.lemmas():
+            synonym = l.name().replace("_", " ").replace("-", " ").lower()
+            synonyms.add(''.join([char for char in synonym if char.isalpha() or char == ' ']))
+    return sorted(synonyms)
+
+
+def _candidate_names(word: str, pos: Optional[str]) -> List[str]:
+    wordnet = _wordnet()
+    try:
+        syn_lst = wordnet.synsets(word, pos)
+        if len(syn_lst) == 0:
+            syn_lst = wordnet.synsets(word)
+    except:
+        try:
+            syn_lst = wordnet.synsets(word)
+        except:
+            return []
+    return list(dict.fromkeys(l.name().lower() for syn in syn_lst for l in syn.lemmas()))
+
+
+def wordnet_synonyms(word: str) -> List[str]:
+    """Uncached lookup behind TextAugmenter.get_synonyms."""
+    return [name for name in _lemma_names(word) if name != word]
+
+
+def wordnet_keyword_candidates(word: str, pos: Optional[str]) -> List[str]:
+    """Uncached lookup behind TextAugmenter.get_new_keyword."""
+    return [name for name in _candidate_names(word, pos) if name != word]
+
+
+def wordnet_entries() -> Iterable[Tuple[str, Dict[str, List[str]]]]:
+    """
+    Yields (lemma, payload) for every WordNet lemma name. The payload holds the unfiltered
+    results of both lookups; the word itself is removed at query time, since callers pass
+    words with their original casing.
+    """
+    wordnet = _wordnet()
+    for lemma in wordnet.all_lemma_names():
+        payload = {_SYNONYMS: _lemma_names(lemma), _ALL: _candidate_names(lemma, None)}
+        for pos in WORDNET_POS:
+            if wordnet.synsets(lemma, pos):
+                payload[pos] = _candidate_names(lemma, pos)
+        yield lemma, payload
+
+
+class MappedSynonymFile:
+    """
+    Read-only view of a file written by MappedSynonymFile.write.
+
+    Layout: magic, entry count, one little-endian uint64 offset per entry, then the records
+    `key\\0json\\n` sorted by key bytes. The file is memory-mapped, so worker processes
+    share the pages through the OS cache and a lookup is a binary search over the offsets.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = _HEADER.unpack_from(self._mm, 0)
+        if magic != _MAGIC:
+            raise ValueError(f"{path} is not a synonym index file")
+        self._offsets = np.frombuffer(self._mm, dtype='<u8', count=count, offset=_HEADER.size)
+        self._data_start = _HEADER.size + 8 * count
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def _key_at(self, i: int) -> Tuple[bytes, int]:
+        start = self._data_start + int(self._offsets[i])
+        end = self._mm.find(b'\x00', start)
+        return self._mm[start:end], end + 1
+
+    def get(self, key: str) -> Optional[Dict[str, List[str]]]:
+        target = key.encode('utf-8')
+        lo, hi = 0, len(self._offsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key, payload_start = self._key_at(mid)
+            if mid_key < target:
+                lo = mid + 1
+            elif mid_key > target:
+                hi = mid
+            else:
+                return json.loads(self._mm[payload_start:self._mm.find(b'\n', payload_start)])
+        return None
+
+    def close(self):
+        self._offsets = None
+        self._mm.close()
+
+    @staticmethod
+    def write(path: str, entries: Iterable[Tuple[str, Dict[str, List[str]]]]) -> int:
+        records = sorted((key.encode('utf-8'), json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+                         for key, payload in entries)
+        offsets = np.zeros(len(records), dtype='<u8')
+        position = 0
+        for i, (key, payload) in enumerate(records):
+            offsets[i] = position
+            position += len(key) + len(payload) + 2
+        with open(path, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, len(records)))
+            f.write(offsets.tobytes())
+            for key, payload in records:
+                f.write(key + b'\x00' + payload + b'\n')
+        return len(records)
+
+
+class SynonymIndex:
+    """
+    Synonym lookups for TextAugmenter with a bounded LRU cache keyed by (word, pos).
+
+    pos=None gives the get_synonyms result (cleaned lemma names of all synsets), a pos letter
+    gives the get_new_keyword result. With `index_path` the answers come from a prebuilt
+    MappedSynonymFile; words missing from it (e.g. inflected forms WordNet resolves through
+    morphy) fall back to live WordNet unless `fallback_to_wordnet` is False.
+    """
+
+    def __init__(self, index_path: Optional[str] = None, cache_size: int = 200_000, fallback_to_wordnet: bool = True):
+        self.index_path = index_path
+        self.cache_size = cache_size
+        self.fallback_to_wordnet = fallback_to_wordnet
+        self._setup()
+
+    def _setup(self):
+        self._index = MappedSynonymFile(self.index_path) if self.index_path else None
+        self._cached_lookup = lru_cache(maxsize=self.cache_size)(self._lookup)
+
+    def _lookup(self, word: str, pos: Optional[str]) -> Tuple[str, ...]:
+        count("synonym_cache_misses")
+        if self._index is not None:
+            payload = self._index.get(word.lower())
+            if payload is not None:
+                if pos is None:
+                    return tuple(name for name in payload.get(_SYNONYMS, []) if name != word)
+                candidates = payload.get(pos) if pos in WORDNET_POS else None
+                return tuple(name for name in (candidates or payload.get(_ALL, [])) if name != word)
+            if not self.fallback_to_wordnet:
+                return ()
+        with _WORDNET_LOCK, timed("wordnet_lookup"):
+            if pos is None:
+                return tuple(wordnet_synonyms(word))
+            return tuple(wordnet_keyword_candidates(word, pos))
+
+    def lookup(self, word: str, pos: Optional[str] = None) -> Tuple[str, ...]:
+        return self._cached_lookup(word, pos)
+
+    def cache_info(self):
+        return self._cached_lookup.cache_info()
+
+    def __getstate__(self):
+        return {'index_path': self.index_path, 'cache_size': self.cache_size, 'fallback_to_wordnet': self.fallback_to_wordnet}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._setup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute the WordNet synonym index used by TextAugmenter.")
+    parser.add_argument("--output", type=str, required=True, help="Path of the index file to write.")
+    args = parser.parse_args()
+    n_entries = MappedSynonymFile.write(args.output, wordnet_entries())
+    print(f"Wrote {n_entries} entries to {args.output}")
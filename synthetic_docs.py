@@ -0,0 +1,89 @@
+import io
+import json
+import random
+import tarfile
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from PIL import Image, ImageDraw
+
+from font_cache import FONT_CACHE
+
+# used when no vocabulary is given; mixed lengths so every augmentation op and the keyword path get work
+DEFAULT_VOCABULARY = ("the", "of", "and", "report", "tobacco", "research", "company", "product", "sales", "marketing",
+                      "smoking", "health", "committee", "meeting", "january", "budget", "analysis", "results", "program",
+                      "development", "consumer", "brand", "advertising", "department", "memorandum", "confidential",
+                      "subject", "director", "manufacturing", "laboratory", "evaluation", "regional", "quarterly", "1987",
+                      "page", "total", "per", "cent", "increase", "project", "samples", "documents", "attached", "review")
+
+
+def boilerplate_lines(n: int, seed: int = 0, vocabulary: Sequence[str] = DEFAULT_VOCABULARY) -> List[str]:
+    """n fixed lines (letterheads, footers, form fields) for synthetic pages to repeat."""
+    rng = random.Random(f"boilerplate/{seed}")
+    return [' '.join(rng.choice(vocabulary) for _ in range(rng.randint(3, 12))) for _ in range(n)]
+
+
+def synthetic_page(rng: random.Random, size: Tuple[int, int], n_lines: int, font_path: str,
+                   vocabulary: Sequence[str] = DEFAULT_VOCABULARY, boilerplate: Sequence[str] = (),
+                   boilerplate_fraction: float = 0.0) -> Tuple[Image.Image, Dict[str, Any]]:
+    """
+    A bilevel page of n_lines lines of random words, with annotation in the layout of examples/original:
+    text, bbox [left, top, width, height] and poly normalized to the page size, and OCR scores.
+    With boilerplate, about boilerplate_fraction of the lines are picked from it instead.
+    """
+    width, height = size
+    page = Image.new('1', size, 1)
+    draw = ImageDraw.Draw(page)
+    margin_x, margin_y = int(0.08 * width), int(0.06 * height)
+    pitch = (height - 2 * margin_y) / max(n_lines, 1)
+    font = FONT_CACHE.get(font_path, max(6, int(0.6 * pitch)))
+    annotation = {'text': [], 'bbox': [], 'poly': [], 'score': []}
+    for i in range(n_lines):
+        # long lines are needed for keyword replacement, which is only picked for lines over 50 characters
+        if boilerplate and rng.random() < boilerplate_fraction:
+            text = rng.choice(boilerplate)
+        else:
+            text = ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(2, 14)))
+        x0, y0 = margin_x + rng.randint(0, int(0.1 * width)), margin_y + i * pitch
+        draw.text((x0, y0), text, fill=0, font=font)
+        left, top, right, bottom = draw.textbbox((x0, y0), text, font=font)
+        right, bottom = min(right, width), min(bottom, height)
+        bbox = [left / width, top / height, (right - left) / width, (bottom - top) / height]
+        annotation['text'].append(text)
+        annotation['bbox'].append(bbox)
+        annotation['poly'].append([{'X': bbox[0], 'Y': bbox[1]}, {'X': bbox[0] + bbox[2], 'Y': bbox[1]},
+                                   {'X': bbox[0] + bbox[2], 'Y': bbox[1] + bbox[3]}, {'X': bbox[0], 'Y': bbox[1] + bbox[3]}])
+        annotation['score'].append(round(rng.uniform(0.9, 1.0), 4))
+    return page, annotation
+
+
+def synthetic_document(rng: random.Random, n_pages: int, n_lines: int, size: Tuple[int, int], font_path: str,
+                       vocabulary: Sequence[str] = DEFAULT_VOCABULARY, dpi: int = 300, boilerplate: Sequence[str] = (),
+                       boilerplate_fraction: float = 0.0) -> Tuple[bytes, Dict[str, Any]]:
+    """A group4 multi-page TIFF and its metadata, like the tif/json pairs of the IDL shards."""
+    pages, annotations = [], []
+    for _ in range(n_pages):
+        page, annotation = synthetic_page(rng, size, n_lines, font_path, vocabulary, boilerplate, boilerplate_fraction)
+        pages.append(page)
+        annotations.append(annotation)
+    buffer = io.BytesIO()
+    pages[0].save(buffer, format='TIFF', compression='group4', save_all=True, append_images=pages[1:], dpi=(dpi, dpi))
+    return buffer.getvalue(), {'pages': annotations}
+
+
+def write_synthetic_shard(tar_path: str, n_documents: int, n_pages: int, n_lines: int, size: Tuple[int, int], font_path: str,
+                          seed: int = 0, vocabulary: Optional[Sequence[str]] = None, boilerplate: Sequence[str] = (),
+                          boilerplate_fraction: float = 0.0) -> List[str]:
+    """Writes n_documents synthetic documents as <key>.tif / <key>.json members of an uncompressed tar and returns the keys."""
+    rng = random.Random(seed)
+    keys = []
+    with tarfile.open(tar_path, 'w') as tar:
+        for i in range(n_documents):
+            key = f"synth{seed:04d}{i:06d}"
+            tiff_bytes, metadata = synthetic_document(rng, n_pages, n_lines, size, font_path, vocabulary or DEFAULT_VOCABULARY,
+                                                      boilerplate=boilerplate, boilerplate_fraction=boilerplate_fraction)
+            for extension, data in (("tif", tiff_bytes), ("json", json.dumps(metadata).encode('utf-8'))):
+                info = tarfile.TarInfo(f"{key}.{extension}")
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+            keys.append(key)
+    return keys
@@ -1,14 +1,31 @@
 import random
 import numpy as np
-from nltk.tag.stanford import StanfordPOSTagger
 import RAKE
-from nltk.corpus import wordnet
 import re
-class TextAugmenter:
-    def __init__(self, stopwords_path, pos_model_path, pos_jar_path):
-        self.stopwords = self.get_stopwords(stopwords_path)
-        self.pos_tagger = StanfordPOSTagger(model_filename=pos_model_path, path_to_jar=pos_jar_path, java_options="-mx4000m")
+import time
+from augmentation_backends import AugmentationBackend, per_line_rngs
+from instrumentation import METRICS, timed
+from pos_tagging import StanfordTaggerEngine
+from synonym_index import SynonymIndex
+
+_SPACES = re.compile(' +')
+AUG_OPS = ('insertion', 'kreplacement', 'swap', 'deletion')
+
+class TextAugmenter(AugmentationBackend):
+    """
+    Line-level augmentations, the default augmentation backend. Every method that draws random numbers
+    takes an optional `rng` (a random.Random, or the random module itself, which is the default), so a
+    caller that passes its own generator gets reproducible results independently of other threads.
+    """
+    needs_tags = True
+
+    def __init__(self, stopwords_path, pos_model_path=None, pos_jar_path=None, pos_tagger=None, synonym_index=None):
+        self.stopwords = frozenset(self.get_stopwords(stopwords_path))
+        # any pos_tagging.POSTagger works here, e.g. RuleBasedPOSTagger when Java is not available
+        self.pos_tagger = pos_tagger if pos_tagger is not None else StanfordTaggerEngine(pos_model_path, pos_jar_path, java_options="-mx4000m")
         self.rake = RAKE.Rake(stopwords_path)
+        # memoized WordNet lookups, optionally served from a prebuilt memory-mapped index
+        self.synonym_index = synonym_index if synonym_index is not None else SynonymIndex()
 
     @staticmethod
     def get_stopwords(path):
@@ -16,20 +33,20 @@ class TextAugmenter:
             stopwords = f.readlines()
         return [x.strip() for x in stopwords]
 
-    def random_deletion(self, words, p):
+    def random_deletion(self, words, p, rng=random):
         if len(words) <= 1:
             return words
-        new_words = [word for word in words if random.uniform(0, 1) > p]
-        return new_words if new_words else [random.choice(words)]
+        new_words = [word for word in words if rng.uniform(0, 1) > p]
+        return new_words if new_words else [rng.choice(words)]
 
-    def swap_word(self, new_words):
+    def swap_word(self, new_words, rng=random):
         if len(new_words) < 2:
             return new_words  # Early exit if there are not enough words to swap
     
-        random_idx_1 = random.randint(0, len(new_words)-1)
+        random_idx_1 = rng.randint(0, len(new_words)-1)
         counter = 0
         while True:
-            random_idx_2 = random.randint(0, len(new_words)-1)
+            random_idx_2 = rng.randint(0, len(new_words)-1)
             if random_idx_1 != random_idx_2:
                 new_words[random_idx_1], new_words[random_idx_2] = new_words[random_idx_2], new_words[random_idx_1]
                 break
@@ -38,42 +55,45 @@ class TextAugmenter:
                 break
         return new_words
 
-    def random_swap(self, words, n):
+    def random_swap(self, words, n, rng=random):
         new_words = words.copy()
         for _ in range(n):
-            new_words = self.swap_word(new_words)
+            new_words = self.swap_word(new_words, rng)
         return new_words
 
     def get_synonyms(self, word):
-        synonyms = set()
-        for syn in wordnet.synsets(word):
-            for l in syn.lemmas():
-                synonym = l.name().replace("_", " ").replace("-", " ").lower()
-                synonyms.add(''.join([char for char in synonym if char.isalpha() or char == ' ']))
-        synonyms.discard(word)
-        return list(synonyms)
-
-    def random_insertion(self, words, n):
+        return list(self.synonym_index.lookup(word))
+
+    def random_insertion(self, words, n, rng=random):
         new_words = words.copy()
         for _ in range(n):
-            self.add_word(new_words)
+            self.add_word(new_words, rng)
         return new_words
 
-    def add_word(self, new_words):
+    def add_word(self, new_words, rng=random):
         non_stopwords = [word for word in new_words if word not in self.stopwords]
         if not non_stopwords:
             return new_words
-        random_word = random.choice(non_stopwords)
+        random_word = rng.choice(non_stopwords)
         synonyms = self.get_synonyms(random_word)
         if synonyms:
-            random_synonym = random.choice(synonyms)
-            random_idx = random.randint(0, len(new_words) - 1)
+            random_synonym = rng.choice(synonyms)
+            random_idx = rng.randint(0, len(new_words) - 1)
             new_words.insert(random_idx, random_synonym)
 
-    def extract_keywords_and_POS(self, prompt):
+    def tag_batch(self, prompts):
+        """Tags all prompts in one call to the tagger. A failed batch yields None for every prompt."""
+        try:
+            return self.pos_tagger.tag_batch([prompt.split() for prompt in prompts])
+        except Exception as e:
+            print(f"ERROR TAGGING BATCH of {len(prompts)} prompts: {str(e)}")
+            return [None] * len(prompts)
+
+    def extract_keywords_and_POS(self, prompt, tagged_prompt=None):
         POS_dict = {}
         try:
-            tagged_prompt = self.pos_tagger.tag(prompt.split())
+            if tagged_prompt is None:
+                tagged_prompt = self.pos_tagger.tag(prompt.split())
         except Exception as e:
             print(f"ERROR PROMPT: {prompt}, {str(e)}")
             return False
@@ -92,23 +112,9 @@ class TextAugmenter:
             return keywords_dict
     
     def get_new_keyword(self, word, pos):
-        synonyms = []
-        try:
-            syn_lst = wordnet.synsets(word, pos)
-            if len(syn_lst) == 0:
-                syn_lst = wordnet.synsets(word)
-        except:
-            try:
-                syn_lst = wordnet.synsets(word)
-            except:
-                return synonyms
-        for syn in syn_lst:
-            for l in syn.lemmas():
-                if l.name().lower() != word:
-                    synonyms.append(l.name().lower())
-        return list(dict.fromkeys(synonyms))
+        return list(self.synonym_index.lookup(word, pos))
         
-    def single_prompt_helper(self, keywords_lst, keywords_dict, fnc, chosen_nums):
+    def single_prompt_helper(self, keywords_lst, keywords_dict, fnc, chosen_nums, rng=random):
         counter = 1
         chosen_keywords_lst = []
         chosen_replacements_lst = []
@@ -122,17 +128,20 @@ class TextAugmenter:
                 if len(candidates) != 0:
                     counter += 1
                     chosen_keywords_lst.append(keyword)
-                    chosen_replacement = random.choice(candidates)
+                    chosen_replacement = rng.choice(candidates)
                     chosen_replacements_lst.append(chosen_replacement)
             else:
                 return chosen_keywords_lst, chosen_replacements_lst
         return chosen_keywords_lst, chosen_replacements_lst
 
 
-    def single_prompt_wordnet(self, prompt, nums_lst):
+    def single_prompt_wordnet(self, prompt, nums_lst, tagged_prompt=None, rng=random):
+        return self.replace_keywords(prompt, nums_lst, self.extract_keywords_and_POS(prompt, tagged_prompt), rng)
+
+    def replace_keywords(self, prompt, nums_lst, keywords_dict, rng=random):
+        """The random part of single_prompt_wordnet, given the result of extract_keywords_and_POS."""
         original_prompt = prompt
         synonyms_prompt_str = ""  # Initialize an empty string to store the synonyms
-        keywords_dict = self.extract_keywords_and_POS(prompt)
         
         if keywords_dict is False:  # Check if keyword extraction failed
             return ''
@@ -141,7 +150,7 @@ class TextAugmenter:
         num_keywords = len(keywords_lst)
         prompt_synonym = original_prompt
         
-        chosen_keywords, chosen_synonyms = self.single_prompt_helper(keywords_lst, keywords_dict, self.get_new_keyword, nums_lst)
+        chosen_keywords, chosen_synonyms = self.single_prompt_helper(keywords_lst, keywords_dict, self.get_new_keyword, nums_lst, rng)
         counter = 1
         
         for chosen_word, chosen_synonym in zip(chosen_keywords, chosen_synonyms):
@@ -152,36 +161,80 @@ class TextAugmenter:
             
         return synonyms_prompt_str.strip() 
 
-    def random_aug(self, sentence, alpha, choice):
-        words = sentence.split(' ')
-        words = [word for word in words if word != '']
+    @staticmethod
+    def tokenize(sentence):
+        return [word for word in sentence.split(' ') if word != '']
+
+    def random_aug(self, sentence, alpha, choice, tagged_sentence=None, rng=random):
+        if choice == 'kreplacement':
+            return self.replace_keywords(sentence, [3], self.extract_keywords_and_POS(sentence, tagged_sentence), rng)
+        return self._augment_words(sentence, self.tokenize(sentence), alpha, choice, rng)
+
+    def _augment_words(self, sentence, words, alpha, choice, rng):
         num_words = len(words)
         n1 = max(1, int(alpha*num_words))
     
         if choice == 'insertion':
-            a_words = self.random_insertion(words, n1)
+            a_words = self.random_insertion(words, n1, rng)
             if len(a_words) == 0 or ' '.join(a_words) == sentence:
                 result_sentence = ''
             else:
                 result_sentence = ' '.join(a_words)
-                result_sentence = re.sub(' +', ' ', result_sentence)
+                result_sentence = _SPACES.sub(' ', result_sentence)
     
         elif choice == 'swap':
-            a_words = self.random_swap(words, n1)
+            a_words = self.random_swap(words, n1, rng)
             if len(a_words) == 0 or ' '.join(a_words) == sentence:
                 result_sentence = ''
             else:
                 result_sentence = ' '.join(a_words)
     
         elif choice == 'deletion':
-            a_words = self.random_deletion(words, alpha)
+            a_words = self.random_deletion(words, alpha, rng)
             if len(a_words) == 0 or ' '.join(a_words) == sentence:
                 result_sentence = ''
             else:
                 result_sentence = ' '.join(a_words)
-        elif choice == 'kreplacement':
-            result_sentence = self.single_prompt_wordnet(sentence, [3])
         else:
             raise ValueError("Invalid choice. Choose from 'insertion','kreplacement', 'swap', or 'deletion'.")
     
         return result_sentence
+
+    def augment_batch(self, lines, alpha, choices, rng=random, tagged_lines=None):
+        """
+        random_aug over many lines (e.g. the selected lines of a page, or of all its versions) in one call.
+
+        The work that draws no random numbers is done up front and once per distinct line: tokenizing,
+        tagging the keyword replacement lines that have no entry in `tagged_lines` (one tagger batch)
+        and extracting their keywords. The ops themselves then run in line order, so for the same rng
+        state the results are the same as calling random_aug on each line in turn. With a list of rngs, line i
+        draws from rng[i] only.
+        """
+        for choice in choices:
+            if choice not in AUG_OPS:
+                raise ValueError("Invalid choice. Choose from 'insertion','kreplacement', 'swap', or 'deletion'.")
+        tagged_lines = dict(tagged_lines or {})
+        kreplacement_lines = list(dict.fromkeys(line for line, choice in zip(lines, choices) if choice == 'kreplacement'))
+        untagged = [line for line in kreplacement_lines if tagged_lines.get(line) is None]
+        if untagged:
+            tagged_lines.update(zip(untagged, self.tag_batch(untagged)))
+        with timed("keyword_extraction"):
+            keywords = {line: self.extract_keywords_and_POS(line, tagged_lines.get(line)) for line in kreplacement_lines}
+        tokens = {line: self.tokenize(line) for line in dict.fromkeys(lines)}
+        new_lines = []
+        # op timings are summed here and recorded once per op, a timer per line costs as much as a swap
+        spent = {choice: [0, 0.0] for choice in set(choices)}
+        for line, choice, line_rng in zip(lines, choices, per_line_rngs(rng, len(lines))):
+            start = time.perf_counter()
+            if choice == 'kreplacement':
+                new_lines.append(self.replace_keywords(line, [3], keywords[line], line_rng))
+            else:
+                new_lines.append(self._augment_words(line, tokens[line], alpha, choice, line_rng))
+            spent[choice][0] += 1
+            spent[choice][1] += time.perf_counter() - start
+        for choice, (n, seconds) in spent.items():
+            METRICS.add_time(f"random_aug.{choice}", seconds, n)
+        return new_lines
+
+    def close(self):
+        self.pos_tagger.close()
@@ -0,0 +1,172 @@
+import io
+import struct
+import zlib
+from dataclasses import dataclass
+from typing import Iterable, List, Optional
+
+from PIL import Image, TiffImagePlugin, TiffTags
+
+# Pillow compression names accepted as EncodeConfig.codec
+CODECS = ("tiff_deflate", "group4", "tiff_lzw", "packbits", "raw")
+# tags that point into the file or to other IFDs and cannot be copied along with a page
+_POINTER_TAGS = {273, 279, 288, 289, 324, 325, 330, 34665, 34853, 40965}
+_STRIP_OFFSETS, _STRIP_BYTE_COUNTS, _TILE_OFFSETS, _TILE_BYTE_COUNTS = 273, 279, 324, 325
+# mode -> (rawmode, bits per sample, photometric interpretation, extra samples) for the zlib writer
+_DEFLATE_LAYOUTS = {
+    '1': ('1', (1,), 1, None),
+    'L': ('L', (8,), 1, None),
+    'RGB': ('RGB', (8, 8, 8), 2, None),
+    'RGBA': ('RGBA', (8, 8, 8, 8), 2, 2),
+}
+_STRIP_SIZE = 256 * 1024
+
+
+@dataclass
+class EncodeConfig:
+    """
+    How the versions of a document are written.
+    - codec: Pillow TIFF compression. "group4" only applies to bilevel pages, others fall back to deflate.
+    - deflate_level: zlib level 1-9 for "tiff_deflate". None keeps Pillow/libtiff's default; a level
+      switches to a zlib strip writer, which also releases the GIL while compressing.
+    - workers: number of versions of a page encoded at once (threads).
+    - reuse_unchanged: pages left untouched in every version are encoded once and shared; when the
+      source is a TIFF their original compressed strips are copied without decoding or re-encoding.
+    """
+    codec: str = "tiff_deflate"
+    deflate_level: Optional[int] = None
+    workers: int = 3
+    reuse_unchanged: bool = True
+
+
+def _single_page_tiff(ifd: TiffImagePlugin.ImageFileDirectory_v2, chunks: List[bytes], offsets_tag: int, counts_tag: int) -> bytes:
+    """Little-endian TIFF laid out like Pillow writes it: header, IFD, then the strips or tiles."""
+    relative_offsets, position = [], 0
+    for chunk in chunks:
+        relative_offsets.append(position)
+        position += len(chunk)
+    ifd[counts_tag] = tuple(len(chunk) for chunk in chunks)
+    ifd.tagtype[counts_tag] = TiffTags.LONG
+    # tobytes moves StripOffsets past the IFD by itself, tile offsets have to be absolute already
+    ifd[offsets_tag] = tuple(relative_offsets)
+    ifd.tagtype[offsets_tag] = TiffTags.LONG
+    if offsets_tag != _STRIP_OFFSETS:
+        data_start = 8 + len(ifd.tobytes(8))
+        ifd[offsets_tag] = tuple(data_start + offset for offset in relative_offsets)
+    return b'II*\x00' + struct.pack('<L', 8) + ifd.tobytes(8) + b''.join(chunks)
+
+
+def copy_raw_page(source: Image.Image, index: int) -> Optional[bytes]:
+    """
+    Single-page TIFF holding frame `index` of `source` with its compressed strips (or tiles) copied
+    byte for byte, so the page is neither decoded nor re-encoded. Returns None when that is not
+    possible: not a TIFF, the file handle is gone, or big-endian multi-byte samples.
+    """
+    if not isinstance(source, TiffImagePlugin.TiffImageFile) or source.fp is None:
+        return None
+    try:
+        # a frame of its own: seeking `source` without loading would carry a palette over to its next frame
+        source = Image.open(source.fp)
+        source.seek(index)
+        tags = source.tag_v2
+        if tags.prefix != b'II' and any(bits > 8 for bits in tags.get(258, (1,))):
+            return None
+        offsets_tag, counts_tag = (_TILE_OFFSETS, _TILE_BYTE_COUNTS) if _TILE_OFFSETS in tags else (_STRIP_OFFSETS, _STRIP_BYTE_COUNTS)
+        offsets, counts = tags.get(offsets_tag), tags.get(counts_tag)
+        if not offsets or not counts or len(offsets) != len(counts):
+            return None
+        chunks = []
+        for offset, count in zip(offsets, counts):
+            source.fp.seek(offset)
+            chunks.append(source.fp.read(count))
+        if any(len(chunk) != count for chunk, count in zip(chunks, counts)):
+            return None
+        ifd = TiffImagePlugin.ImageFileDirectory_v2()
+        for tag, value in tags.items():
+            if tag not in _POINTER_TAGS:
+                ifd[tag] = value
+                ifd.tagtype[tag] = tags.tagtype[tag]
+        return _single_page_tiff(ifd, chunks, offsets_tag, counts_tag)
+    except (OSError, ValueError, KeyError, struct.error):
+        return None
+
+
+def _deflate_page(image: Image.Image, level: int) -> Optional[bytes]:
+    layout = _DEFLATE_LAYOUTS.get(image.mode)
+    if layout is None:
+        return None
+    rawmode, bits, photometric, extra_samples = layout
+    width, height = image.size
+    row_bytes = (width * sum(bits) + 7) // 8
+    rows_per_strip = max(1, min(height, _STRIP_SIZE // max(row_bytes, 1)))
+    raw = image.tobytes('raw', rawmode)
+    chunks = [zlib.compress(raw[top * row_bytes:(top + rows_per_strip) * row_bytes], level)
+              for top in range(0, height, rows_per_strip)]
+    ifd = TiffImagePlugin.ImageFileDirectory_v2()
+    ifd[256], ifd[257] = width, height
+    ifd[258] = bits
+    ifd[259] = 8  # Adobe deflate
+    ifd[262] = photometric
+    ifd[277] = len(bits)
+    ifd[278] = rows_per_strip
+    ifd[284] = 1
+    if extra_samples is not None:
+        ifd[338] = extra_samples
+    return _single_page_tiff(ifd, chunks, _STRIP_OFFSETS, _STRIP_BYTE_COUNTS)
+
+
+def _clear_ifd_padding(data: bytes) -> bytes:
+    """
+    libtiff writes the IFD after the strips at an even offset and leaves the byte skipped for that
+    uninitialized, so the same page could be encoded to different bytes. That byte is set to zero.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as page:
+            tags = page.tag_v2
+            offsets_tag, counts_tag = (_TILE_OFFSETS, _TILE_BYTE_COUNTS) if _TILE_OFFSETS in tags else (_STRIP_OFFSETS, _STRIP_BYTE_COUNTS)
+            data_end = max(offset + count for offset, count in zip(tags[offsets_tag], tags[counts_tag]))
+            ifd_offset = struct.unpack(('<' if tags.prefix == b'II' else '>') + 'L', data[4:8])[0]
+    except (OSError, ValueError, KeyError, struct.error):
+        return data
+    if 0 < ifd_offset - data_end < 4:
+        return data[:data_end] + bytes(ifd_offset - data_end) + data[ifd_offset:]
+    return data
+
+
+def _page_codec(image: Image.Image, config: EncodeConfig) -> str:
+    if config.codec == "group4" and image.mode != '1':
+        return "tiff_deflate"
+    return config.codec
+
+
+def encode_page(image: Image.Image, config: EncodeConfig) -> bytes:
+    """One page as a complete single-page TIFF stream."""
+    codec = _page_codec(image, config)
+    if codec == "tiff_deflate" and config.deflate_level is not None:
+        data = _deflate_page(image, config.deflate_level)
+        if data is not None:
+            return data
+    buffer = io.BytesIO()
+    image.save(buffer, format='TIFF', compression=codec)
+    return _clear_ifd_padding(buffer.getvalue()) if codec != "raw" else buffer.getvalue()
+
+
+class TiffAppender:
+    """A multi-page TIFF in memory that single-page TIFF streams are appended to one at a time, as they are ready."""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        self._writer = TiffImagePlugin.AppendingTiffWriter(self.buffer)
+        self.n_pages = 0
+
+    def append(self, data: bytes):
+        self._writer.write(data)
+        self._writer.newFrame()
+        self.n_pages += 1
+
+
+def write_tiff(frames: Iterable[Image.Image], config: EncodeConfig) -> io.BytesIO:
+    """Multi-page TIFF from images, written frame by frame."""
+    appender = TiffAppender()
+    for frame in frames:
+        appender.append(encode_page(frame, config))
+    return appender.buffer